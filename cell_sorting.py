@@ -62,10 +62,12 @@ class RoiFile:
     brain region, and it willhave a dataset 'xy' which is are the
     vertices of the ROI.
 
-    'markers' is a group with 3 datasets, each row corresponds to a
+    'markers' is a group with 4 datasets, each row corresponds to a
     marker (i.e. a cell) in the brain section:
         'c'    [string] colour name of the marker.
         'm'    [string] mpl marker character.
+        'n'    [string] name of the marker's class (files saved by
+               older versions do not have it).
         'xy'   [integer] x, y coordinates of the marker.
 
     attributes of '/' include image size, resolution, name, atlas_ref.
@@ -146,10 +148,17 @@ class RoiFile:
         """
         ontology = Ontology()
         sorted_markers = pd.DataFrame(index=np.arange(self.nmarkers))
+        # Only the markers within the bounding box of each ROI can be
+        # inside it, so only those are tested against its outline.
+        markers = self.markers.reshape(-1, 2)
         for roi_name, roi_xy in self.rois.items():
-            path = Path(roi_xy)
-            sorted_markers[roi_name] = path.contains_points(
-                    self.markers)
+            lo, hi = roi_xy.min(0), roi_xy.max(0)
+            candidates = np.flatnonzero(
+                    np.all((markers >= lo) & (markers <= hi), axis=1))
+            inside = np.zeros(self.nmarkers, bool)
+            inside[candidates] = Path(roi_xy).contains_points(
+                    markers[candidates])
+            sorted_markers[roi_name] = inside
 
         # Raise an error if a marker is not assigned to at least one
         # ROI.
@@ -0,0 +1,194 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+
+from tiles import TiledImage, TILESIZE
+
+
+def colour_lut(mappable, dtype):
+    '''
+    Return a lookup table with the RGB colour (as uint8) of every value
+    of the integer type 'dtype' (uint8 or uint16), according to the
+    colourmap and display range of 'mappable'.
+    '''
+    values = np.arange(np.iinfo(dtype).max + 1, dtype=dtype)
+    return mappable.to_rgba(values, bytes=True)[:, :3]
+
+
+class Layer(object):
+    '''
+    One channel of a composite image and its display settings.
+
+    Input:
+
+      name      Identifies the layer in the tile cache, and sets the
+                order in which layers are blended (lowest first).
+      pyramid   The channel's image pyramid (see pyramid.Pyramid). It
+                may be set later; layers without a pyramid are not
+                displayed.
+      cmap      Colourmap, a matplotlib colormap or its name.
+      clim      Display range (min, max).
+    '''
+    def __init__(self, name, pyramid=None, cmap=None, clim=None):
+        self.name = name
+        self.pyramid = pyramid
+        self.mappable = ScalarMappable(Normalize(), cmap)
+        if clim is not None:
+            self.set_clim(*clim)
+        self.alpha = 1.
+        self.visible = False
+        self._lut = None
+        self._lut_key = None
+
+    def set_clim(self, vmin, vmax):
+        self.mappable.set_clim(vmin, vmax)
+
+    def get_clim(self):
+        return self.mappable.get_clim()
+
+    def set_cmap(self, cmap):
+        self.mappable.set_cmap(cmap)
+
+    def is_shown(self):
+        return self.visible and self.pyramid is not None
+
+    def key(self):
+        '''
+        Return the settings that this layer's tiles depend on.
+        '''
+        vmin, vmax = self.get_clim()
+        if vmin is None or vmax is None:
+            self.mappable.autoscale_None(self.pyramid[-1])
+            vmin, vmax = self.get_clim()
+        return (self.name, vmin, vmax, self.mappable.cmap.name)
+
+    def lut(self, dtype):
+        '''
+        Return the lookup table for the current display settings (see
+        'colour_lut'), computing it only if those have changed.
+        '''
+        key = self.key() + (dtype,)
+        if key != self._lut_key:
+            self._lut = colour_lut(self.mappable, dtype)
+            self._lut_key = key
+        return self._lut
+
+    def render_tile(self, level, row, col, cache, store=True):
+        '''
+        Return tile ('row', 'col') of pyramid 'level' colour-mapped as an
+        RGB array of type uint8. The tile is taken from 'cache' if it
+        is there, and added to it if 'store' is True.
+        '''
+        key = (level, (row, col)) + self.key()
+        tile = cache.get(key)
+        if tile is None:
+            yx = self.pyramid[level]
+            tile = yx[row*TILESIZE:(row+1)*TILESIZE,
+                      col*TILESIZE:(col+1)*TILESIZE]
+            # 8- and 16-bit images are mapped with a lookup table,
+            # which avoids normalising the data to floats.
+            if tile.dtype in (np.uint8, np.uint16):
+                tile = self.lut(tile.dtype).take(tile, axis=0)
+            else:
+                tile = self.mappable.to_rgba(tile, bytes=True)[..., :3]
+            if store:
+                cache.put(key, tile)
+        return tile
+
+
+class CompositeImage(TiledImage):
+    '''
+    A single image that displays all visible channels of a
+    multi-channel image blended together.
+
+    Each visible layer is colour-mapped tile by tile, and the tiles of
+    all layers are combined into one RGB tile in a single weighted sum,
+    so that matplotlib only has to draw one image regardless of the
+    number of channels. Blending modes are:
+
+      'overlay'     Layers are stacked over a black background, each
+                    one covering those below according to its alpha
+                    value (as when drawing one image per channel).
+      'composite'   Layers are added together, each weighted by its
+                    alpha value, and the result is clipped (as in
+                    ImageJ's composite mode).
+    '''
+    def __init__(self, ax, shape, cache=None, blending='overlay',
+                 **kwargs):
+        super(CompositeImage, self).__init__(ax, None, cache=cache,
+                                             **kwargs)
+        self.shape = shape
+        self.blending = blending
+        self.layers = []
+
+    def add_layer(self, layer):
+        self.layers.append(layer)
+        self.layers.sort(key=lambda layer: layer.name)
+
+    def shown_layers(self):
+        return [layer for layer in self.layers if layer.is_shown()]
+
+    @property
+    def pyramid(self):
+        # All layers have the same size, so any visible layer sets the
+        # geometry of the tiles.
+        layers = self.shown_layers()
+        return layers[0].pyramid if layers else None
+
+    @pyramid.setter
+    def pyramid(self, pyramid):
+        pass
+
+    def get_image_extent(self):
+        h, w = self.shape
+        return (-0.5, w - 0.5, h - 0.5, -0.5)
+
+    def weights(self, layers):
+        '''
+        Return the weight of each layer in the blended image.
+        '''
+        alpha = np.array([layer.alpha for layer in layers], np.float32)
+        if self.blending == 'composite':
+            return alpha
+        # Overlay: each layer is attenuated by all layers above it.
+        above = np.append(np.cumprod((1 - alpha)[::-1])[::-1][1:], 1)
+        return alpha * above
+
+    def view_key(self):
+        layers = self.shown_layers()
+        return (self.blending,) + tuple(
+                layer.key() + (layer.alpha,) for layer in layers)
+
+    def render_tile(self, level, row, col):
+        key = ('composite', level, (row, col)) + self.view_key()
+        tile = self.cache.get(key)
+        if tile is None:
+            layers = self.shown_layers()
+            tiles = np.stack([layer.render_tile(level, row, col,
+                                                self.cache, self.caching)
+                              for layer in layers])
+            tile = np.tensordot(self.weights(layers), tiles, axes=1)
+            tile = np.minimum(tile, 255).astype(np.uint8)
+            if self.caching:
+                self.cache.put(key, tile)
+        return tile
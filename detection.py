@@ -0,0 +1,276 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Detection of cells (bright blobs) in a channel.
+
+The channel is processed in overlapping tiles, in parallel in a pool of
+processes. In each tile:
+
+  1. The background (the tile smoothed at a scale much larger than the
+     cells) is subtracted.
+  2. The tile is filtered by a difference of Gaussians (DoG), an
+     approximation of the Laplacian of Gaussian tuned to blobs of the
+     given radius.
+  3. Cells are the local maxima of the filtered tile (within a cell's
+     radius) that are larger than 'threshold' times the noise of the
+     tile, estimated from the median absolute deviation of the
+     filtered tile.
+
+Gaussians are approximated by repeated box filters, computed from
+cumulative sums, so that their cost does not depend on their size.
+'''
+
+import multiprocessing
+import os
+from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                wait)
+
+import numpy as np
+
+# Ratio of the sigmas of the Gaussians of the DoG.
+DOGRATIO = 1.6
+# Scale of the background, in cell radii.
+BACKGROUNDSCALE = 8
+# Number of box filters used to approximate a Gaussian.
+NBOXES = 3
+
+
+def box_sizes(sigma, n=NBOXES):
+    '''
+    Return the (odd) widths of 'n' box filters that, applied one after
+    the other, approximate a Gaussian of standard deviation 'sigma'.
+    '''
+    ideal = np.sqrt(12 * sigma**2 / n + 1)
+    lower = int(ideal)
+    if lower % 2 == 0:
+        lower -= 1
+    upper = lower + 2
+    m = round((12 * sigma**2 - n * lower**2 - 4 * n * lower - 3 * n) /
+              (-4 * lower - 4))
+    return [lower if i < m else upper for i in range(n)]
+
+
+def _slice(axis, start, stop):
+    index = [slice(None)] * 2
+    index[axis] = slice(start, stop)
+    return tuple(index)
+
+
+def box_filter(a, width, axis):
+    '''
+    Return the mean of 'a' (2D) over windows of 'width' (odd) elements
+    along 'axis', extending the edges of 'a'.
+    '''
+    r = width // 2
+    pad = [(0, 0)] * 2
+    pad[axis] = (r + 1, r)
+    c = np.cumsum(np.pad(a, pad, mode='edge'), axis=axis, dtype=a.dtype)
+    n = a.shape[axis]
+    result = c[_slice(axis, width, width + n)] - c[_slice(axis, 0, n)]
+    result /= width
+    return result
+
+
+def gaussian(a, sigma):
+    '''
+    Return 'a' smoothed by a Gaussian of standard deviation 'sigma'
+    (see box_sizes).
+    '''
+    for width in box_sizes(sigma):
+        if width > 1:
+            a = box_filter(a, width, 0)
+            a = box_filter(a, width, 1)
+    return a
+
+
+def local_maxima(a, rows, cols, radius):
+    '''
+    Return a boolean array, True where the element of 'a' at 'rows',
+    'cols' is the maximum of 'a' within 'radius' elements of it (along
+    each axis). Only those elements are tested, which is much faster
+    than filtering all of 'a' when they are few.
+    '''
+    h, w = a.shape
+    values = a[rows, cols]
+    result = np.ones(len(values), bool)
+    for i in range(-radius, radius + 1):
+        r = np.clip(rows + i, 0, h - 1)
+        for j in range(-radius, radius + 1):
+            c = np.clip(cols + j, 0, w - 1)
+            result &= a[r, c] <= values
+    return result
+
+
+def resize(a, shape):
+    '''
+    Resize 'a' to 'shape' by linear interpolation.
+    '''
+    for axis, n in enumerate(shape):
+        m = a.shape[axis]
+        pos = (np.arange(n) + 0.5) * m / n - 0.5
+        pos = np.clip(pos, 0, m - 1)
+        i = np.minimum(pos.astype(int), max(m - 2, 0))
+        w = pos - i
+        shape = [1] * a.ndim
+        shape[axis] = n
+        w = w.reshape(shape).astype(a.dtype)
+        lo = np.take(a, i, axis=axis)
+        hi = np.take(a, np.minimum(i + 1, m - 1), axis=axis)
+        hi -= lo
+        hi *= w
+        a = lo + hi
+    return a
+
+
+def subtract_background(a, scale):
+    '''
+    Subtract the background of 'a', i.e. 'a' smoothed by a Gaussian of
+    standard deviation 'scale'. The background is computed on 'a'
+    reduced by a factor of about scale/4, which is enough to represent
+    it and much faster.
+    '''
+    factor = max(int(scale // 4), 1)
+    h, w = a.shape
+    hh, ww = -(-h // factor), -(-w // factor)
+    padded = np.pad(a, ((0, hh*factor - h), (0, ww*factor - w)),
+                    mode='edge')
+    small = padded.reshape(hh, factor, ww, factor).mean(
+            axis=(1, 3), dtype=a.dtype)
+    background = resize(gaussian(small, scale / factor), (hh*factor,
+                                                          ww*factor))
+    return a - background[:h, :w]
+
+
+def detect(tile, radius, threshold):
+    '''
+    Return the coordinates (row, column) and the DoG response of the
+    cells in 'tile' (see the module's docstring).
+    '''
+    # Single precision is enough once the background, which would
+    # dominate the cumulative sums of the box filters, is subtracted.
+    a = tile.astype(np.float32)
+    a = subtract_background(a, BACKGROUNDSCALE * radius)
+    sigma = radius / np.sqrt(2)
+    dog = gaussian(a, sigma) - gaussian(a, DOGRATIO * sigma)
+    # The noise is estimated from a subsample, which is as good and
+    # much faster.
+    sample = dog[::4, ::4]
+    median = np.median(sample)
+    noise = 1.4826 * np.median(np.abs(sample - median))
+    rows, cols = np.nonzero(dog > median + threshold * noise)
+    peaks = local_maxima(dog, rows, cols, int(round(radius)))
+    rows, cols = rows[peaks], cols[peaks]
+    return rows, cols, dog[rows, cols]
+
+
+def split(shape, tilesize, margin):
+    '''
+    Yield the tiles of an image of 'shape', as tuples (r0, r1, c0, c1,
+    inner), where 'inner' is the part of the tile (relative to its
+    origin) that is not shared with other tiles. Tiles extend 'margin'
+    pixels beyond their inner part into their neighbours.
+    '''
+    h, w = shape
+    for i in range(0, h, tilesize):
+        for j in range(0, w, tilesize):
+            r0, r1 = max(i - margin, 0), min(i + tilesize + margin, h)
+            c0, c1 = max(j - margin, 0), min(j + tilesize + margin, w)
+            inner = (i - r0, min(i + tilesize, h) - r0,
+                     j - c0, min(j + tilesize, w) - c0)
+            yield r0, r1, c0, c1, inner
+
+
+def _detect_tile(tile, origin, inner, radius, threshold):
+    rows, cols, response = detect(tile, radius, threshold)
+    i0, i1, j0, j1 = inner
+    keep = (rows >= i0) & (rows < i1) & (cols >= j0) & (cols < j1)
+    xy = np.column_stack([cols[keep] + origin[1], rows[keep] + origin[0]])
+    return xy, response[keep]
+
+
+def process_pool(workers=None):
+    '''
+    Return a pool of 'workers' processes (default: one per CPU) to
+    detect cells in (see 'detect_cells').
+
+    Workers are spawned rather than forked: forking a process (e.g. the
+    GUI) while other threads in it hold locks (e.g. the prefetcher's,
+    reading files) can deadlock the workers. Spawned workers import
+    the main module again, so a pool is best kept and reused.
+    '''
+    context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(workers or os.cpu_count(),
+                               mp_context=context)
+
+
+def _detect_tiles(executor, yx, tiles, radius, threshold, workers):
+    # Keep only a few tiles per worker in flight, so that the image is
+    # not copied to the workers all at once.
+    results = []
+    pending = set()
+    for r0, r1, c0, c1, inner in tiles:
+        if len(pending) >= 2 * workers:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            results.extend(f.result() for f in done)
+        pending.add(executor.submit(
+                _detect_tile, np.array(yx[r0:r1, c0:c1]), (r0, c0),
+                inner, radius, threshold))
+    results.extend(f.result() for f in pending)
+    return results
+
+
+def detect_cells(yx, radius=5, threshold=5, tilesize=1024, workers=None,
+                 executor=None):
+    '''
+    Detect cells of about 'radius' pixels in image 'yx' (see the
+    module's docstring). Return an array of shape (N, 2) with their
+    coordinates (x, y), and an array with the strength (DoG response)
+    of each.
+
+    Tiles of 'tilesize' pixels are processed by 'executor' (e.g. a pool
+    from 'process_pool') if given, or else by a pool of 'workers'
+    processes (default: one per CPU) created for this call, or in this
+    process if 'workers' is 0.
+
+    Each peak is only reported by the tile whose inner part contains
+    it, so that cells in the overlap are not duplicated.
+    '''
+    margin = int(np.ceil(BACKGROUNDSCALE * radius))
+    tiles = split(yx.shape[:2], tilesize, margin)
+    results = []
+    if executor is None and workers == 0:
+        for r0, r1, c0, c1, inner in tiles:
+            results.append(_detect_tile(yx[r0:r1, c0:c1], (r0, c0),
+                                        inner, radius, threshold))
+    elif executor is None:
+        with process_pool(workers) as executor:
+            results = _detect_tiles(executor, yx, tiles, radius,
+                                    threshold, workers or os.cpu_count())
+    else:
+        results = _detect_tiles(executor, yx, tiles, radius, threshold,
+                                workers or os.cpu_count())
+    if not results:
+        return np.empty((0, 2)), np.empty(0)
+    xy = np.concatenate([xy for xy, response in results])
+    response = np.concatenate([response for xy, response in results])
+    # Tiles finish in any order; sort cells by row, then column.
+    order = np.lexsort((xy[:, 0], xy[:, 1]))
+    return xy[order].astype(float), response[order]
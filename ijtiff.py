@@ -18,10 +18,15 @@
 # You should have received a copy of the GNU General Public License
 # along with roimanager. If not, see <http://www.gnu.org/licenses/>.
 
+from functools import partial
+
 import numpy as np
 from tifffile import TiffFile
 from matplotlib.colors import LinearSegmentedColormap, ListedColormap
 
+# Intensity projections available for Z-stacks.
+PROJECTIONS = ('max', 'min', 'mean', 'sum')
+
 
 def std_cmap(colour):
     '''
@@ -73,14 +78,98 @@ def lut_to_cmap(lut):
     return ListedColormap(rgb)
 
 
+def project(planes, method='max'):
+    '''
+    Return the intensity projection of a sequence of planes.
+
+    Planes are used one at the time (e.g. as they are read from file),
+    so that only the result and one plane need to be in memory.
+
+    Input:
+        planes    An iterable of 2-d arrays, all of the same shape.
+        method    'max', 'min', 'mean' or 'sum'.
+
+    Returns:
+        An array of the same type as the planes, except for 'sum'
+        projections, which are of type uint32 for 8- and 16-bit planes,
+        int64 for other integer planes, and float64 for float planes.
+    '''
+    if method not in PROJECTIONS:
+        raise ValueError("Unknown projection '{}'".format(method))
+    result = None
+    for n, yx in enumerate(planes, 1):
+        if result is None:
+            dtype = yx.dtype
+            if method in ('max', 'min'):
+                result = np.array(yx)
+            elif dtype.kind == 'f':
+                result = yx.astype(np.float64)
+            elif dtype.kind == 'u' and dtype.itemsize <= 2:
+                result = yx.astype(np.uint32)
+            else:
+                result = yx.astype(np.int64)
+        elif method == 'max':
+            np.maximum(result, yx, out=result)
+        elif method == 'min':
+            np.minimum(result, yx, out=result)
+        else:
+            result += yx
+    if method == 'mean':
+        if dtype.kind == 'f':
+            result /= n
+        else:
+            result = (result + n // 2) // n
+        result = result.astype(dtype)
+    return result
+
+
 class Channel:
-    def __init__(self, n, yx, cmap, rnge):
-        self.yx = yx
+    def __init__(self, n, yx, cmap, rnge, shape=None, planes=None,
+                 nplanes=1):
+        '''
+        'yx' is either the channel's image data or a function (taking
+        no arguments) that returns them. In the latter case 'shape'
+        must be given, and the data are only read the first time that
+        the attribute 'yx' is accessed.
+
+        For Z-stacks, 'yx' is a projection of the stack, and 'planes'
+        is a function that takes a plane number (0 to 'nplanes' - 1)
+        and returns that plane.
+        '''
+        if callable(yx):
+            self._read = yx
+            self._yx = None
+            self.shape = shape
+        else:
+            self._read = None
+            self._yx = yx
+            self.shape = yx.shape
+        self._plane = planes
+        self.nplanes = nplanes
         self.cmap = cmap
-        self.shape = yx.shape
         self.range = rnge
         self.n = n
 
+    @property
+    def yx(self):
+        if self._yx is None:
+            self._yx = self._read()
+        return self._yx
+
+    def is_loaded(self):
+        return self._yx is not None
+
+    def plane(self, z):
+        '''
+        Return plane 'z' of the channel. Planes of Z-stacks are read
+        from file each time, so the image must still be open.
+        '''
+        if self._plane is None:
+            if z != 0:
+                raise IndexError('Channel has only one plane')
+            return self.yx
+        return self._plane(z)
+
 
 class IJTiff(object):
     '''
@@ -116,8 +205,30 @@ class IJTiff(object):
        colormaps. This is achieved with
        matplotlib.colors.ListedColormap, see function 'std_cm' above.
 
+
+    Lazy loading:
+    ------------
+
+    By default all channels are read into memory when the file is
+    opened. With 'lazy=True' uncompressed, contiguous files are
+    memory-mapped instead, and all other files are decoded one
+    channel at the time, the first time that the channel's data
+    ('channel.yx') are used. In lazy mode the file is kept open until
+    'close' is called.
+
+
+    Z-stacks:
+    --------
+
+    The data of each channel of a Z-stack ('channel.yx') are an
+    intensity projection of all its planes, of the type given by
+    'projection' (see function 'project'). Planes are read from file
+    and projected one at the time, so that the stack is never in
+    memory. Individual planes can be read with 'channel.plane' while
+    the file is open.
+
     '''
-    def __init__(self, fname):
+    def __init__(self, fname, lazy=False, projection='max'):
         tif = TiffFile(fname)
         # This class is only for ImageJ tiffs.
         assert tif.is_imagej is True
@@ -127,21 +238,35 @@ class IJTiff(object):
         # 'CYX' for multiple-channels, single stack images, etc.
         axes = tif.series[0].axes
 
-        # Images with z-stacks are not yet supported.
-        if 'Z' in axes:
-            raise NotImplementedError("Z-stacks are not supported")
+        # Z-stacks are supported as long as Z is the outermost
+        # dimension ('ZYX', 'ZCYX' or 'ZYXS'). Each plane is then
+        # handled like an image without Z.
+        self.is_zstack = 'Z' in axes
+        if self.is_zstack:
+            if not axes.startswith('Z'):
+                raise NotImplementedError(
+                        "Z-stacks of type {} are not supported".format(
+                            axes))
+            if projection not in PROJECTIONS:
+                raise ValueError(
+                        "Unknown projection '{}'".format(projection))
+            self.nplanes = tif.series[0].shape[0]
+            axes = axes[1:]
+        else:
+            self.nplanes = 1
+        self.projection = projection
 
         # Shape of file will only reflect (x, y) dimensions. Number
         # of channels is stored elsewhere.
         x_indx = axes.find('X')
         y_indx = axes.find('Y')
-        shape = tif.series[0].shape
+        shape = tif.series[0].shape[int(self.is_zstack):]
         self.shape = (shape[y_indx], shape[x_indx])
 
         # Read tags and extract relevant information.
         self.fname = tif.filename
         self.fpath = tif.filehandle.path
-        self.nchannels = tif.imagej_metadata['channels']
+        self.nchannels = tif.imagej_metadata.get('channels', 1)
         # If the image contains its own luts, use them. (Is this the
         # case with all images where 'mode' is 'composite'?)
         if 'luts'in tif.imagej_metadata:
@@ -153,16 +278,37 @@ class IJTiff(object):
         else:
             colours = ('b', 'g', 'r', 'm', 'c')[:self.nchannels]
             cmaps = [std_cmap(colour) for colour in colours]
-        ranges = tif.imagej_metadata['Ranges']
-        ranges = np.array(ranges).reshape(self.nchannels, -1)
+        ranges = self._ranges(tif)
 
-        # Read image data.
-        im = tif.asarray()
+        # Read image data. In lazy mode, memory-map the data if they are
+        # stored in the file in their final form. Otherwise 'im' is None
+        # and each channel will be read from file when first needed
+        # (see '_read_channel'). Z-stacks are always projected from
+        # their planes (see '_project').
+        self._tif = tif
+        self._samples = None
+        self.axes = axes
+        series = tif.series[0]
+        if self.is_zstack:
+            im = None
+        elif not lazy:
+            im = tif.asarray()
+        elif series.offset is not None and series.pages[0].is_memmappable:
+            im = tif.asarray(out='memmap')
+        else:
+            im = None
+        ndim = len(axes)
         # Single-channel images.
-        if im.ndim == 2:
-            self.__dict__['chan1'] = Channel(1, im, cmaps, ranges)
+        if ndim == 2:
+            if self.is_zstack:
+                im = partial(self._project, 0)
+            elif im is None:
+                im = partial(self._read_channel, 0)
+            self.__dict__['chan1'] = Channel(1, im, cmaps[0], ranges[0],
+                                             self.shape,
+                                             *self._planes(0))
         # Multi-channel images.
-        elif im.ndim == 3:
+        elif ndim == 3:
             for n in range(self.nchannels):
                 # Multi-channel images are of type 'CYX' (first
                 # dimension of the data array is 'channel'), where each
@@ -171,7 +317,11 @@ class IJTiff(object):
                 # equivalent to channel), where all channels are
                 # contained in the same tiff page and the page's
                 # 'samples_per_pixel' is > 1.
-                if axes == 'YXS':
+                if self.is_zstack:
+                    yx = partial(self._project, n)
+                elif im is None:
+                    yx = partial(self._read_channel, n)
+                elif axes == 'YXS':
                     yx = im[:, :, n]
                 elif axes == 'CYX':
                     yx = im[n, :, :]
@@ -180,7 +330,8 @@ class IJTiff(object):
                 # are displayed/named in ImageJ (i.e first channel is
                 # number one, not 0.
                 self.__dict__['chan%i' % (n+1)] = Channel(
-                        n+1, yx, cmaps[n], ranges[n])
+                        n+1, yx, cmaps[n], ranges[n], self.shape,
+                        *self._planes(n))
         else:
             raise NotImplementedError("Images with more than " +
                                       "3 dimensions are not supported.")
@@ -190,10 +341,103 @@ class IJTiff(object):
                 'image_name': tif.filename,
                 'image_width': tif.pages[0].imagewidth,
                 'image_length': tif.pages[0].imagelength,
-                'unit': tif.imagej_metadata['unit'],
-                'x_resolution': tif.pages[0].tags['XResolution'].value,
-                'y_resolution': tif.pages[0].tags['YResolution'].value
+                'unit': tif.imagej_metadata.get('unit', ''),
+                'x_resolution': self._resolution(tif, 'XResolution'),
+                'y_resolution': self._resolution(tif, 'YResolution')
                 }
+        if self.is_zstack:
+            self.tags['z_planes'] = self.nplanes
+            self.tags['z_projection'] = projection
+
+        # If not in lazy mode, read all data now; then the file is no
+        # longer needed.
+        if not lazy:
+            for chan in self:
+                chan.yx
+            self.close()
+
+    def _ranges(self, tif):
+        '''
+        Return the display range of each channel. ImageJ saves them
+        ('Ranges') only for multi-channel images; single-channel images
+        may have instead 'min' and 'max'. Otherwise the range of the
+        data type is used (0-1 for floating point data).
+        '''
+        metadata = tif.imagej_metadata
+        if 'Ranges' in metadata:
+            ranges = metadata['Ranges']
+        elif 'min' in metadata and 'max' in metadata:
+            ranges = [metadata['min'], metadata['max']] * self.nchannels
+        else:
+            dtype = tif.series[0].dtype
+            if np.issubdtype(dtype, np.integer):
+                info = np.iinfo(dtype)
+                ranges = [info.min, info.max] * self.nchannels
+            else:
+                ranges = [0., 1.] * self.nchannels
+        return np.array(ranges).reshape(self.nchannels, -1)
+
+    @staticmethod
+    def _resolution(tif, tag):
+        '''
+        Return the value of resolution 'tag' of the image, or (1, 1)
+        if the image is not calibrated and thus has none.
+        '''
+        tags = tif.pages[0].tags
+        if tag not in tags:
+            return (1, 1)
+        return tags[tag].value
+
+    def _planes(self, n):
+        '''
+        Return the arguments 'planes' and 'nplanes' for creating
+        channel 'n' (zero-based).
+        '''
+        if not self.is_zstack:
+            return None, 1
+        return partial(self._read_plane, n), self.nplanes
+
+    def _read_plane(self, n, z):
+        '''
+        Read from file plane 'z' of channel 'n' (both zero-based) of a
+        Z-stack.
+        '''
+        series = self._tif.series[0]
+        # ImageJ stores one page per plane and channel, with channels
+        # varying fastest, or one page per plane with all channels as
+        # samples.
+        if self.axes == 'YXS':
+            return series.pages[z].asarray()[:, :, n]
+        return series.pages[z*self.nchannels + n].asarray()
+
+    def _project(self, n):
+        '''
+        Compute the projection of channel 'n' (zero-based) of a
+        Z-stack, reading one plane at the time.
+        '''
+        planes = (self._read_plane(n, z) for z in range(self.nplanes))
+        return project(planes, self.projection)
+
+    def _read_channel(self, n):
+        '''
+        Read from file the data of channel 'n' (zero-based).
+        '''
+        series = self._tif.series[0]
+        # In 'YXS' images all channels are in the same tiff page. Decode
+        # that page only once and keep it for the other channels.
+        if self.axes == 'YXS':
+            if self._samples is None:
+                self._samples = series.pages[0].asarray()
+            return self._samples[:, :, n]
+        # Otherwise there is one tiff page per channel.
+        return series.pages[n].asarray()
+
+    def close(self):
+        '''
+        Close the file. Channels that were not yet read (in lazy mode)
+        can no longer be loaded after this.
+        '''
+        self._tif.close()
 
     def __iter__(self):
         keys = list(self.__dict__.keys())
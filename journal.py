@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+from contextlib import contextmanager
+
+from matplotlib import cbook
+
+
+class Journal(object):
+    '''
+    History of edits, to undo and redo them.
+
+    Each edit is recorded as a pair of functions, one that undoes it and
+    one that does it again. These only hold what the edit changed (e.g.
+    the markers removed, or the old and new name of a ROI), not a copy
+    of all markers and ROIs, so that undoing and redoing take time in
+    proportion to the edit.
+
+    Edits are undone in the reverse order in which they were made, and
+    redone in the same order, so that an edit is always undone or
+    redone in the state in which it left things (or found them). Thus,
+    edits may refer to markers and ROIs by their position. A new edit
+    discards the edits that had been undone.
+
+    Edits made while undoing or redoing are not recorded. Functions
+    connected to the 'changed' event of 'callbacks' are called, with the
+    Journal as argument, whenever edits are recorded, undone or redone.
+    '''
+    def __init__(self, maxlen=None):
+        self._undo = deque(maxlen=maxlen)
+        self._redo = []
+        self._replaying = False
+        self._group = None
+        self.callbacks = cbook.CallbackRegistry(signals=['changed'])
+
+    def record(self, undo, redo):
+        '''
+        Record an edit, given functions (taking no arguments) to undo
+        and to redo it.
+        '''
+        if self._replaying:
+            return
+        if self._group is not None:
+            self._group.append((undo, redo))
+            return
+        self._undo.append((undo, redo))
+        self._redo = []
+        self.callbacks.process('changed', self)
+
+    @contextmanager
+    def group(self):
+        '''
+        Context manager to record all edits made within it as one, so
+        that they are undone and redone together.
+        '''
+        if self._group is not None:
+            yield
+            return
+        self._group = []
+        try:
+            yield
+        finally:
+            edits, self._group = self._group, None
+            if edits:
+                self.record(lambda: self._replay(edits, 0, reverse=True),
+                            lambda: self._replay(edits, 1))
+
+    @staticmethod
+    def _replay(edits, n, reverse=False):
+        for edit in (reversed(edits) if reverse else edits):
+            edit[n]()
+
+    def can_undo(self):
+        return len(self._undo) > 0
+
+    def can_redo(self):
+        return len(self._redo) > 0
+
+    def undo(self):
+        if not self._undo:
+            return False
+        edit = self._undo.pop()
+        self._run(edit[0])
+        self._redo.append(edit)
+        self.callbacks.process('changed', self)
+        return True
+
+    def redo(self):
+        if not self._redo:
+            return False
+        edit = self._redo.pop()
+        self._run(edit[1])
+        self._undo.append(edit)
+        self.callbacks.process('changed', self)
+        return True
+
+    def _run(self, function):
+        self._replaying = True
+        try:
+            function()
+        finally:
+            self._replaying = False
+
+    def clear(self):
+        self._undo.clear()
+        self._redo = []
+        self.callbacks.process('changed', self)
@@ -18,20 +18,197 @@
 # You should have received a copy of the GNU General Public License
 # along with roimanager. If not, see <http://www.gnu.org/licenses/>.
 
+from functools import partial
+
 import numpy as np
+from matplotlib import cbook
+
+from spatial import GridIndex
+
+
+def snap(yx, x, y, radius, method='max'):
+    '''
+    Return the position of the intensity peak ('max') or the centroid
+    of the bright blob ('centroid') of image 'yx' within 'radius'
+    pixels of 'x', 'y'. Only that window of the image is read.
+
+    The centroid is weighted by intensity above half the way between
+    the lowest and the highest value in the window, so that the
+    background around the blob does not pull it towards the centre of
+    the window. If the window is flat, 'x', 'y' are returned unchanged.
+    '''
+    height, width = yx.shape[:2]
+    col, row = int(round(x)), int(round(y))
+    if not (0 <= col < width and 0 <= row < height):
+        return x, y
+    r0, c0 = max(row - radius, 0), max(col - radius, 0)
+    patch = np.asarray(yx[r0:row+radius+1, c0:col+radius+1], float)
+    vmin, vmax = patch.min(), patch.max()
+    if vmin == vmax:
+        return x, y
+    if method == 'max':
+        i, j = np.unravel_index(np.argmax(patch), patch.shape)
+        return c0 + j, r0 + i
+    elif method == 'centroid':
+        weights = np.clip(patch - (vmin + vmax) / 2, 0, None)
+        rows, cols = np.indices(patch.shape)
+        total = weights.sum()
+        return (c0 + (cols * weights).sum() / total,
+                r0 + (rows * weights).sum() / total)
+    raise ValueError('Unknown snap method: {}'.format(method))
+
+
+class MarkerSet(object):
+    '''
+    A class of markers with common attributes (name, marker shape and
+    colour). All the markers of a class are drawn by a single artist,
+    a Line2D with markers but no line, whose data are set by the
+    MarkerManager. The artist is animated, i.e. it is not drawn with
+    the rest of the figure but by the MarkerManager (see 'on_draw').
+
+    The coordinates of the markers are kept in an array that grows in
+    blocks, so that markers can be appended without copying the
+    others, and are only passed to the artist (which copies them) when
+    it is next drawn in full. Markers drawn on their own (e.g. those
+    just added) are drawn by a second artist with the same style.
+    '''
+    def __init__(self, ax, name, marker, colour, mec, ms, mew):
+        self.ax = ax
+        self.name = name
+        self.marker = marker
+        self.colour = colour
+        self.line, = ax.plot([], [], linestyle='none', marker=marker,
+                             mfc=colour, mec=mec, ms=ms, mew=mew,
+                             label=name, animated=True)
+        self.new, = ax.plot([], [], linestyle='none', marker=marker,
+                            mfc=colour, mec=mec, ms=ms, mew=mew,
+                            animated=True)
+        self._xy = np.empty((0, 2))
+        self.n = 0
+        self._stale = False
+
+    def set_xy(self, xy):
+        self._xy = np.array(xy, float).reshape(-1, 2)
+        self.n = len(self._xy)
+        self._stale = True
+
+    def append(self, xy):
+        n = self.n + len(xy)
+        if n > len(self._xy):
+            self._xy = np.resize(self._xy, (max(2*len(self._xy), n, 64),
+                                            2))
+        self._xy[self.n:n] = xy
+        self.n = n
+        self._stale = True
+
+    def draw(self, xy=None):
+        '''
+        Draw the markers on the canvas, or only those at 'xy' if
+        given.
+        '''
+        if xy is None:
+            if self._stale:
+                xy = self._xy[:self.n]
+                self.line.set_data(xy[:, 0], xy[:, 1])
+                self._stale = False
+            self.ax.draw_artist(self.line)
+            return
+        self.new.set_data(xy[:, 0], xy[:, 1])
+        self.ax.draw_artist(self.new)
+
+    def set_visible(self, visible):
+        self.line.set_visible(visible)
+        self.new.set_visible(visible)
+
+    def remove(self):
+        self.line.remove()
+        self.new.remove()
 
 
 class MarkerManager(object):
+    '''
+    Markers placed on the image (e.g. counted cells).
+
+    Markers are kept in arrays with one row per marker: their
+    coordinates ('xy'), the index of their class in 'classes' ('cls'),
+    and a unique id ('ids', increasing in the order in which markers
+    were added). The arrays grow in blocks, so that adding a marker
+    does not copy all the others, and each class is drawn by a single
+    artist (see MarkerSet), so that drawing does not slow down as the
+    number of markers grows. Markers are also indexed by position (see
+    spatial.GridIndex), so that finding the marker under the pointer
+    does not require testing all of them.
+
+    Adding or removing a marker does not redraw the figure. Markers
+    are drawn after the rest of the figure, once the canvas (the
+    images and ROIs) has been saved as a background, and are then
+    updated by blitting: a new marker is drawn over what is on screen,
+    and after removing a marker the background is restored and the
+    remaining markers drawn over it.
+
+    Clicked positions can be snapped (see 'snap'), within SNAPRADIUS
+    image pixels, to the peak or the centroid of the image returned by
+    'snap_image' (a function, e.g. returning the current channel), if
+    'snap_method' is set to 'max' or 'centroid'.
+
+    New markers are added to the class named 'current'. Functions
+    connected to the 'changed' event of 'callbacks' are called, with
+    the MarkerManager as argument, whenever markers are added, removed
+    or shown/hidden, and those connected to the 'added' and 'removed'
+    events with the MarkerManager and the coordinates of the markers
+    added or removed. If 'journal' is set (see journal.Journal), adding
+    and removing markers, and changing their class, are recorded there
+    so that they can be undone.
+    '''
     MARKERFACECOLOUR = 'yellow'
     MARKEREDGECOLOUR = 'black'
     MARKEREDGEWIDTH = 1.5
     MARKERSIZE = 4.5
     MARKER = 'o'
+    DEFAULTCLASS = 'default'
+    # Distance (in screen pixels) within which a click selects a
+    # marker.
+    PICKRADIUS = 5
+    # Side (in image pixels) of the cells of the spatial index.
+    INDEXCELLSIZE = 64
+    # Distance (in image pixels) within which clicks are snapped.
+    SNAPRADIUS = 4
 
     def __init__(self, parent):
         self.ax = parent.ax
         self.canvas = parent.canvas
         self.is_dirty = False
+        self.visible = True
+        self.callbacks = cbook.CallbackRegistry(
+                signals=['changed', 'added', 'removed'])
+        self.current = self.DEFAULTCLASS
+        self.snap_method = None
+        self.snap_image = None
+        self.journal = None
+        self.classes = []
+        self.index = GridIndex(self.INDEXCELLSIZE)
+        self._xy = np.empty((0, 2))
+        self._cls = np.empty(0, np.intp)
+        self._ids = np.empty(0, np.int64)
+        self._nextid = 0
+        self.n = 0
+        self._background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def xy(self):
+        return self._xy[:self.n]
+
+    @property
+    def cls(self):
+        return self._cls[:self.n]
+
+    @property
+    def ids(self):
+        return self._ids[:self.n]
 
     def connect_add(self):
         self.cid = self.canvas.mpl_connect('button_press_event',
@@ -47,72 +224,305 @@ class MarkerManager(object):
         if event.inaxes is None:
             return
         x, y = event.xdata, event.ydata
+        if self.snap_method is not None and self.snap_image is not None:
+            yx = self.snap_image()
+            if yx is not None:
+                x, y = snap(yx, x, y, self.SNAPRADIUS, self.snap_method)
+        start = self.n
         self.add(x, y)
-        self.canvas.draw()
+        self.blit(start)
+
+    def on_draw(self, event):
+        '''
+        Save the canvas as background, and draw the markers, after the
+        figure has been drawn.
+        '''
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        for markerset in self.classes:
+            markerset.draw()
+
+    def blit(self, start=None):
+        '''
+        Update the markers on screen without drawing the rest of the
+        figure. If 'start' is given, only the markers from that index
+        on (those just added) are drawn over what is on screen;
+        otherwise the background is restored and all markers drawn
+        over it.
+        '''
+        if self._background is None:
+            self.canvas.draw_idle()
+            return
+        if start is None:
+            self.canvas.restore_region(self._background)
+            for markerset in self.classes:
+                markerset.draw()
+        elif self.visible:
+            cls = self.cls[start:]
+            for k in np.unique(cls):
+                self.classes[k].draw(self.xy[start:][cls == k])
+        self.canvas.blit(self.ax.bbox)
 
     def clear(self):
-        self.ax.lines = []
+        for markerset in self.classes:
+            markerset.remove()
+        self.classes = []
+        self.index.clear()
+        self._xy = np.empty((0, 2))
+        self._cls = np.empty(0, np.intp)
+        self._ids = np.empty(0, np.int64)
+        self.n = 0
+        self._background = None
         self.is_dirty = False
+        self.callbacks.process('changed', self)
 
-    def add(self, x, y, marker=MARKER, mec=MARKEREDGECOLOUR,
-            mfc=MARKERFACECOLOUR, picker=5, ms=MARKERSIZE,
-            mew=MARKEREDGEWIDTH):
-        self.ax.plot([x], [y], marker=marker, mec=mec, mfc=mfc,
-                     picker=picker, ms=ms, mew=mew)
+    def add_class(self, name, marker=None, colour=None):
+        '''
+        Return the index of the class 'name' (with the given marker
+        shape and colour, if given), creating it (by default with
+        MARKER and MARKERFACECOLOUR) if it does not exist. Classes with
+        the same name but different marker shapes or colours are kept
+        apart.
+        '''
+        k = self.find_class(name, marker, colour)
+        if k is not None:
+            return k
+        marker = self.MARKER if marker is None else marker
+        colour = self.MARKERFACECOLOUR if colour is None else colour
+        markerset = MarkerSet(self.ax, name, marker, colour,
+                              self.MARKEREDGECOLOUR, self.MARKERSIZE,
+                              self.MARKEREDGEWIDTH)
+        markerset.set_visible(self.visible)
+        self.classes.append(markerset)
+        return len(self.classes) - 1
+
+    def find_class(self, name, marker=None, colour=None):
+        '''
+        Return the index of the (first) class 'name' with the given
+        marker shape and colour, if given, or None if there is no such
+        class.
+        '''
+        for k, markerset in enumerate(self.classes):
+            if (markerset.name == name and
+                    marker in (None, markerset.marker) and
+                    colour in (None, markerset.colour)):
+                return k
+        return None
+
+    def add(self, x, y, cls=None):
+        '''
+        Add one or more markers at 'x', 'y' (numbers or arrays) to the
+        class with index 'cls' (a number or an array), or to the
+        current class if None.
+        '''
+        xy = np.column_stack([np.ravel(x), np.ravel(y)])
+        if cls is None:
+            cls = self.add_class(self.current)
+        cls = np.broadcast_to(cls, len(xy))
+        ids = np.arange(self._nextid, self._nextid + len(xy))
+        self._nextid += len(xy)
+        start, n = self.n, self.n + len(xy)
+        self._reserve(n)
+        self._xy[start:n] = xy
+        self._cls[start:n] = cls
+        self._ids[start:n] = ids
+        self.n = n
+        self.index.insert(ids, xy)
+        self._append(xy, cls)
+        self.is_dirty = True
+        if self.journal is not None:
+            indices = np.arange(start, n)
+            self.journal.record(partial(self.remove, indices),
+                                partial(self._insert, indices, xy,
+                                        cls.copy(), ids))
+        self.callbacks.process('added', self, xy)
+        self.callbacks.process('changed', self)
+
+    def _reserve(self, n):
+        '''
+        Make room for 'n' markers.
+        '''
+        if n > len(self._xy):
+            size = max(2*len(self._xy), n, 64)
+            self._xy = np.resize(self._xy, (size, 2))
+            self._cls = np.resize(self._cls, size)
+            self._ids = np.resize(self._ids, size)
+
+    def _insert(self, indices, xy, cls, ids):
+        '''
+        Insert markers (e.g. removed before) so that they end up at
+        'indices' (sorted) among the others. Their ids must keep ids
+        increasing with the index of markers.
+        '''
+        n = self.n + len(indices)
+        self._reserve(n)
+        at_end = indices[0] == self.n
+        for values, new in ((self._xy, xy), (self._cls, cls),
+                            (self._ids, ids)):
+            if at_end:
+                # Markers added at the end (the usual case).
+                values[self.n:n] = new
+                continue
+            old = np.ones(n, bool)
+            old[indices] = False
+            merged = np.empty((n,) + values.shape[1:], values.dtype)
+            merged[old] = values[:self.n]
+            merged[indices] = new
+            values[:n] = merged
+        self.n = n
+        self.index.insert(ids, xy)
+        if at_end:
+            self._append(xy, cls)
+        else:
+            self._update(np.unique(cls))
         self.is_dirty = True
+        self.callbacks.process('added', self, xy)
+        self.callbacks.process('changed', self)
+
+    def remove(self, indices):
+        '''
+        Remove the markers with the given indices (in the order in
+        which they were added).
+        '''
+        keep = np.ones(self.n, bool)
+        keep[indices] = False
+        indices = np.flatnonzero(~keep)
+        if len(indices) == 0:
+            return
+        xy, cls, ids = self.xy[indices], self.cls[indices], self.ids[indices]
+        classes = np.unique(cls)
+        self.index.remove(ids, xy)
+        n = np.count_nonzero(keep)
+        self._xy[:n] = self.xy[keep]
+        self._cls[:n] = self.cls[keep]
+        self._ids[:n] = self.ids[keep]
+        self.n = n
+        self._update(classes)
+        self.is_dirty = True
+        if self.journal is not None:
+            self.journal.record(partial(self._insert, indices, xy, cls,
+                                        ids),
+                                partial(self.remove, indices))
+        self.callbacks.process('removed', self, xy)
+        self.callbacks.process('changed', self)
+
+    def set_class(self, indices, cls):
+        '''
+        Move the markers with the given indices to the class with
+        index 'cls' (a number, or an array with one per marker).
+        '''
+        indices = np.array(indices)
+        old = self.cls[indices]
+        classes = np.unique(np.append(old, cls))
+        self.cls[indices] = cls
+        self._update(classes)
+        self.is_dirty = True
+        if self.journal is not None:
+            self.journal.record(partial(self.set_class, indices, old),
+                                partial(self.set_class, indices, cls))
+        self.callbacks.process('changed', self)
+
+    def _update(self, classes):
+        '''
+        Set the data of the artists of the given classes.
+        '''
+        for k in classes:
+            self.classes[k].set_xy(self.xy[self.cls == k])
+
+    def _append(self, xy, cls):
+        '''
+        Add to the artists of their classes the markers at 'xy' (of
+        classes 'cls') just added after all others. This takes time in
+        proportion to the markers added, not to all markers.
+        '''
+        cls = np.broadcast_to(cls, len(xy))
+        if len(cls) and (cls == cls[0]).all():
+            self.classes[cls[0]].append(xy)
+            return
+        for k in np.unique(cls):
+            self.classes[k].append(xy[cls == k])
+
+    def set_visible(self, visible):
+        self.visible = visible
+        for markerset in self.classes:
+            markerset.set_visible(visible)
+        self.callbacks.process('changed', self)
+
+    def nearest(self, x, y, radius):
+        '''
+        Return the index of the marker nearest to 'x', 'y' that is
+        within 'radius' of it, or None if there is none.
+        '''
+        ids = self.index.query(x-radius, y-radius, x+radius, y+radius)
+        if not ids:
+            return None
+        # Ids increase with the index of markers.
+        indices = np.searchsorted(self.ids, ids)
+        dist = np.hypot(*(self.xy[indices] - (x, y)).T)
+        k = np.argmin(dist)
+        return indices[k] if dist[k] <= radius else None
+
+    def pick_radius(self):
+        '''
+        Return PICKRADIUS in data coordinates at the current zoom.
+        '''
+        xmin, xmax = self.ax.get_xlim()
+        return self.PICKRADIUS * abs(xmax - xmin) / self.ax.bbox.width
 
     def connect_remove(self):
         self.disconnect()
-        self.cid = self.canvas.mpl_connect('pick_event', self.on_remove)
+        self.cid = self.canvas.mpl_connect('button_press_event',
+                                           self.on_remove)
 
     def on_remove(self, event):
         if self.canvas.widgetlock.locked():
             return
-        event.artist.remove()
-        self.canvas.draw()
-        self.is_dirty = True
+        if event.inaxes is None or not self.visible:
+            return
+        indx = self.nearest(event.xdata, event.ydata, self.pick_radius())
+        if indx is None:
+            return
+        self.remove(indx)
+        self.blit()
 
     def get_xy(self):
         # There is no point in keeping data as floats since image
         # pixels are integers. Thus, round and convert to integers
         # to match to image coordinates.
-        xy = [l.get_xydata().flatten() for l in self.ax.lines]
-        xy = np.array(xy)
-        xy = xy.round().astype(int)
-        return xy
+        return self.xy.round().astype(int)
 
-    def get_markers(self):
-        markers = [l.get_marker() for l in self.ax.lines]
+    def _get_attr(self, attr):
+        values = np.array([getattr(markerset, attr)
+                           for markerset in self.classes] or [''])
         # h5py requires ascii, not Unicode. Converting to an array of
         # type "S" avoids TypeErrors in h5py.
-        markers = np.array(markers, dtype="S")
-        return markers
+        return values[self.cls].astype("S")
+
+    def get_markers(self):
+        return self._get_attr('marker')
 
     def get_colours(self):
-        colours = [l.get_mfc() for l in self.ax.lines]
-        # h5py requires ascii, not Unicode. Converting to an array of
-        # type "S" avoids TypeErrors in h5py.
-        colours = np.array(colours, dtype="S")
-        return colours
+        return self._get_attr('colour')
 
     def get_labels(self):
-        labels = [l.get_label() for l in self.ax.lines]
-        return labels
+        return self._get_attr('name')
 
-
-class MarkerSet(object):
-    '''
-    A class to manage a group of markers with common attributes.
-    '''
-    def __init__(self, name):
-        self.name = name
-        self.colour = 'colour'
-        self.xy = []
-        self.marker = 'o'
-        self.label = ''
-
-    def append(self, x, y):
-        self.xy.append([x, y])
-
-    def size(self):
-        return self.xy.size
+    def set_data(self, xy, labels=None, markers=None, colours=None):
+        '''
+        Replace all markers with those in 'xy' (an array of shape
+        (N, 2)). 'labels', 'markers' and 'colours' are the class name,
+        marker shape and colour of each marker, as saved to the data
+        file; classes are created as needed.
+        '''
+        self.clear()
+        if len(xy) == 0:
+            return
+        n = len(xy)
+        labels = [self.DEFAULTCLASS]*n if labels is None else labels
+        markers = [self.MARKER]*n if markers is None else markers
+        colours = [self.MARKERFACECOLOUR]*n if colours is None else colours
+        keys = np.array(['\0'.join(key) for key in
+                         zip(labels, markers, colours)])
+        unique, inverse = np.unique(keys, return_inverse=True)
+        classes = np.array([self.add_class(*key.split('\0'))
+                            for key in unique])
+        self.add(xy[:, 0], xy[:, 1], classes[inverse])
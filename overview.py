@@ -0,0 +1,320 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from matplotlib.colors import to_rgba
+from matplotlib.patches import Rectangle
+from PyQt5.QtCore import QTimer
+
+from rois import simplify
+from tiles import TILESIZE
+from ui.mplcanvas import MplCanvas
+
+
+class Overview(object):
+    '''
+    A thumbnail of the whole image, with the markers and ROIs, that
+    outlines the part of the image in view in the main axes. Clicking
+    on it centres the main view on that point. It is shown over the top
+    right corner of the main canvas, fitted within 'size' pixels.
+
+    The thumbnail is rendered from the smallest level of the image
+    pyramid, and only again when the display settings (channels shown,
+    display ranges, colourmaps) change. The outline of the main view,
+    when it moves, is blitted over the rest of the overview. Thus,
+    keeping the overview up to date never requires drawing the main
+    figure, nor rendering more than a few tiles.
+
+    Markers are shown as an image of the size of the overview that
+    counts the markers in each of its pixels, so that adding or
+    removing markers only updates their pixels. Each ROI is drawn by
+    its own line, simplified to the resolution of the overview, which
+    is only updated when that ROI is added, edited or removed. The
+    overview is then drawn at most once every UPDATEINTERVAL ms.
+    '''
+    VIEWCOLOUR = 'white'
+    MARKERCOLOUR = 'yellow'
+    ROICOLOUR = 'white'
+    # Distance (in pixels) to the edges of the main canvas.
+    MARGIN = 8
+    UPDATEINTERVAL = 100
+
+    def __init__(self, parent, size=200):
+        self.main = parent.ax
+        self.draw_main = parent.draw
+        self.size = size
+        self.canvas = MplCanvas()
+        self.canvas.setParent(parent.canvas)
+        self.canvas.hide()
+        self.ax = self.canvas.figure.add_subplot(111)
+        self.ax.axis('off')
+        self.composite = None
+        self.thumbnail = None
+        self._key = None
+        self._background = None
+        self.view = Rectangle((0, 0), 0, 0, fill=False,
+                              ec=self.VIEWCOLOUR, lw=1, animated=True)
+        self.ax.add_patch(self.view)
+        # Number of markers in each pixel of the overview, and the
+        # image that shows them.
+        self.counts = None
+        self.markers = None
+        self._markers_changed = False
+        self.rois = parent.rois
+        self.roilines = {}
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.UPDATEINTERVAL)
+        self.timer.timeout.connect(self.update)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.canvas.mpl_connect('button_press_event', self.on_press)
+        self.main.figure.canvas.mpl_connect('draw_event', self.on_main_draw)
+        self.main.figure.canvas.mpl_connect('resize_event', self.place)
+        callbacks = parent.markers.callbacks
+        callbacks.connect('added', self.on_markers_added)
+        callbacks.connect('removed', self.on_markers_removed)
+        callbacks.connect('changed', self.on_markers_changed)
+        self.rois.rowsInserted.connect(self.on_rois_inserted)
+        self.rois.rowsAboutToBeRemoved.connect(self.on_rois_removed)
+        self.rois.dataChanged.connect(self.on_rois_changed)
+        self.rois.modelReset.connect(self.on_rois_reset)
+
+    def set_image(self, composite):
+        '''
+        Show the image displayed by 'composite' (a CompositeImage).
+        This must be called once the image has been added to the main
+        axes.
+        '''
+        self.composite = composite
+        xmin, xmax, ymax, ymin = composite.get_image_extent()
+        self.ax.set_xlim(xmin, xmax)
+        self.ax.set_ylim(ymax, ymin)
+        # Fit the canvas to the shape of the image.
+        scale = self.size / max(xmax - xmin, ymax - ymin)
+        width = max(int(round((xmax - xmin)*scale)), 1)
+        height = max(int(round((ymax - ymin)*scale)), 1)
+        self.canvas.setFixedSize(width, height)
+        self.counts = np.zeros((height, width), np.int32)
+        self.markers = self.ax.imshow(
+                np.zeros((height, width, 4), np.uint8),
+                extent=(xmin, xmax, ymax, ymin), interpolation='nearest',
+                aspect='auto', zorder=1)
+        self.place()
+        self.canvas.show()
+        # Callbacks are reset whenever the main axes are cleared.
+        self.main.callbacks.connect('xlim_changed', self.on_main_limits)
+        self.main.callbacks.connect('ylim_changed', self.on_main_limits)
+        self._key = None
+        self.update_thumbnail()
+
+    def place(self, event=None):
+        '''
+        Move the overview to the top right corner of the main canvas.
+        '''
+        main = self.main.figure.canvas
+        self.canvas.move(main.width() - self.canvas.width() - self.MARGIN,
+                         self.MARGIN)
+
+    def clear(self):
+        self.canvas.hide()
+        if self.thumbnail is not None:
+            self.thumbnail.remove()
+        self.thumbnail = None
+        self.composite = None
+        self._key = None
+        self.view.set_bounds(0, 0, 0, 0)
+        if self.markers is not None:
+            self.markers.remove()
+        self.markers = None
+        self.counts = None
+        self._markers_changed = False
+        for line in self.roilines.values():
+            line.remove()
+        self.roilines = {}
+        self.timer.stop()
+        self.canvas.draw_idle()
+
+    def schedule(self):
+        '''
+        Draw the overview within UPDATEINTERVAL ms, together with any
+        other changes made until then.
+        '''
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def update(self):
+        if self._markers_changed and self.markers is not None:
+            self._markers_changed = False
+            rgba = np.zeros(self.counts.shape + (4,), np.uint8)
+            rgba[self.counts > 0] = np.array(
+                    to_rgba(self.MARKERCOLOUR)) * 255
+            self.markers.set_data(rgba)
+        self.canvas.draw_idle()
+
+    def update_thumbnail(self):
+        '''
+        Render the thumbnail again if the display settings of the image
+        have changed since the last time.
+        '''
+        if self.composite is None:
+            return
+        pyramid = self.composite.pyramid
+        key = self.composite.view_key() if pyramid is not None else None
+        if key == self._key:
+            return
+        self._key = key
+        if pyramid is None:
+            # No channel is shown.
+            if self.thumbnail is not None:
+                self.thumbnail.set_visible(False)
+            self.canvas.draw_idle()
+            return
+        level = len(pyramid) - 1
+        h, w = pyramid[level].shape[:2]
+        data, _ = self.composite.render_view(
+                level, (0, -(-h // TILESIZE)), (0, -(-w // TILESIZE)))
+        if self.thumbnail is None:
+            self.thumbnail = self.ax.imshow(
+                    data, extent=self.composite.get_image_extent(),
+                    interpolation='bilinear', aspect='auto', zorder=0)
+        else:
+            self.thumbnail.set_data(data)
+        self.thumbnail.set_visible(True)
+        self.canvas.draw_idle()
+
+    def _count_markers(self, xy, n):
+        '''
+        Add 'n' to the counts of the pixels of the overview where the
+        markers at 'xy' are.
+        '''
+        if self.counts is None or len(xy) == 0:
+            return
+        xmin, xmax, ymax, ymin = self.markers.get_extent()
+        height, width = self.counts.shape
+        cols = np.floor((xy[:, 0] - xmin) / (xmax - xmin) * width)
+        rows = np.floor((xy[:, 1] - ymin) / (ymax - ymin) * height)
+        cols = np.clip(cols, 0, width - 1).astype(int)
+        rows = np.clip(rows, 0, height - 1).astype(int)
+        np.add.at(self.counts, (rows, cols), n)
+        self._markers_changed = True
+        self.schedule()
+
+    def on_markers_added(self, markers, xy):
+        self._count_markers(xy, 1)
+
+    def on_markers_removed(self, markers, xy):
+        self._count_markers(xy, -1)
+
+    def on_markers_changed(self, markers):
+        '''
+        Follow the markers being shown or hidden, or all removed.
+        '''
+        if self.markers is None:
+            return
+        if len(markers) == 0 and self.counts.any():
+            self.counts[...] = 0
+            self._markers_changed = True
+        if self.markers.get_visible() != markers.visible:
+            self.markers.set_visible(markers.visible)
+            self.schedule()
+        elif self._markers_changed:
+            self.schedule()
+
+    def _roi_xy(self, roi):
+        '''
+        Return the outline of 'roi' simplified to the resolution of the
+        overview.
+        '''
+        xy = roi.get_xy()
+        if self.counts is None:
+            return xy
+        xmin, xmax, _, _ = self.markers.get_extent()
+        return simplify(xy, (xmax - xmin) / self.counts.shape[1] / 2)
+
+    def _set_roi(self, roi):
+        xy = self._roi_xy(roi)
+        line = self.roilines.get(roi)
+        if line is None:
+            line, = self.ax.plot(xy[:, 0], xy[:, 1], color=self.ROICOLOUR,
+                                 lw=0.5, zorder=2)
+            self.roilines[roi] = line
+        else:
+            line.set_data(xy[:, 0], xy[:, 1])
+
+    def on_rois_inserted(self, parent, first, last):
+        for row in range(first, last + 1):
+            self._set_roi(self.rois.get_roi(row))
+        self.schedule()
+
+    def on_rois_removed(self, parent, first, last):
+        for row in range(first, last + 1):
+            line = self.roilines.pop(self.rois.get_roi(row), None)
+            if line is not None:
+                line.remove()
+        self.schedule()
+
+    def on_rois_changed(self, first, last, *args):
+        for row in range(first.row(), last.row() + 1):
+            self._set_roi(self.rois.get_roi(row))
+        self.schedule()
+
+    def on_rois_reset(self):
+        for line in self.roilines.values():
+            line.remove()
+        self.roilines = {}
+        for roi in self.rois:
+            self._set_roi(roi)
+        self.schedule()
+
+    def on_main_draw(self, event):
+        self.update_thumbnail()
+
+    def on_main_limits(self, ax):
+        '''
+        Outline the part of the image in view in the main axes.
+        '''
+        xmin, xmax = sorted(self.main.get_xlim())
+        ymin, ymax = sorted(self.main.get_ylim())
+        self.view.set_bounds(xmin, ymin, xmax - xmin, ymax - ymin)
+        if self._background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self._background)
+        self.ax.draw_artist(self.view)
+        self.canvas.blit(self.ax.bbox)
+
+    def on_draw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.view)
+
+    def on_press(self, event):
+        '''
+        Centre the main view on the point clicked, without changing
+        the zoom.
+        '''
+        if event.inaxes is not self.ax or self.composite is None:
+            return
+        xmin, xmax = self.main.get_xlim()
+        ymin, ymax = self.main.get_ylim()
+        dx, dy = (event.xdata - (xmin + xmax)/2,
+                  event.ydata - (ymin + ymax)/2)
+        self.main.set_xlim(xmin + dx, xmax + dx)
+        self.main.set_ylim(ymin + dy, ymax + dy)
+        self.draw_main()
@@ -0,0 +1,173 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from pyramid import file_key
+
+
+class Prefetcher(object):
+    '''
+    Reads files in a background thread before they are needed.
+
+    'read' is a function that takes a file name and returns whatever
+    should be kept for that file (e.g. the decoded image). Files are
+    read one at the time, in the order given to 'prefetch'.
+
+    The memory held by the files read ahead is measured, once each is
+    read, with 'nbytes'. A file is not read if those read before it
+    already hold 'maxbytes', and is discarded if it would take them
+    over 'maxbytes'. Files that are no longer wanted are discarded too,
+    once read if they were being read.
+
+    Input:
+
+      read       Function to read one file.
+      depth      Maximum number of files read ahead.
+      maxbytes   Maximum memory (in bytes) held by the files read
+                 ahead.
+      nbytes     Function that returns the memory (in bytes) held by
+                 the result of 'read'. By default memory is not
+                 limited.
+      discard    Function called with the result of 'read' when it is
+                 discarded (e.g. to close files), or None.
+    '''
+    def __init__(self, read, depth=1, maxbytes=2*2**30, nbytes=None,
+                 discard=None):
+        self.read = read
+        self.depth = depth
+        self.maxbytes = maxbytes
+        self.nbytes = nbytes
+        self.discard = discard
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # For each file being read, its key (see pyramid.file_key), an
+        # identifier of the job, and its future.
+        self._jobs = OrderedDict()
+        # Memory held by the result of each job that has been read and
+        # not yet taken or discarded, by job.
+        self._nbytes = {}
+        self._lock = threading.Lock()
+
+    def _read(self, fname, job):
+        '''
+        Read 'fname' (run in the background thread). Return None if it
+        would take the memory held by the files read ahead over
+        'maxbytes'.
+        '''
+        if self.nbytes is None:
+            return self.read(fname)
+        with self._lock:
+            if sum(self._nbytes.values()) >= self.maxbytes:
+                return None
+        result = self.read(fname)
+        nbytes = self.nbytes(result)
+        with self._lock:
+            if sum(self._nbytes.values()) + nbytes <= self.maxbytes:
+                self._nbytes[job] = nbytes
+                return result
+        if self.discard is not None:
+            self.discard(result)
+        return None
+
+    def prefetch(self, fnames):
+        '''
+        Start reading the files in 'fnames', up to 'depth' files. Files
+        read ahead before that are not in 'fnames' are discarded.
+        '''
+        fnames = list(fnames)[:self.depth]
+        for fname in list(self._jobs):
+            if fname not in fnames:
+                self._drop(self._jobs.pop(fname))
+        for fname in fnames:
+            if fname in self._jobs:
+                continue
+            try:
+                key = file_key(fname)
+            except OSError:
+                continue
+            job = object()
+            future = self._executor.submit(self._read, fname, job)
+            self._jobs[fname] = (key, job, future)
+
+    def _drop(self, job):
+        '''
+        Cancel a job if it has not started, or else discard its result
+        once it is done.
+        '''
+        future = job[2]
+        if not future.cancel():
+            future.add_done_callback(partial(self._discard, job[1]))
+
+    def _discard(self, job, future):
+        with self._lock:
+            self._nbytes.pop(job, None)
+        if future.exception() is not None:
+            return
+        result = future.result()
+        if result is not None and self.discard is not None:
+            self.discard(result)
+
+    def get(self, fname):
+        '''
+        Return the result of reading 'fname', waiting for it if
+        needed, or None if the file was not read ahead, it could not
+        be read, or it has been modified, moved or removed since.
+        '''
+        job = self._jobs.pop(fname, None)
+        if job is None:
+            return None
+        key, job, future = job
+        try:
+            result = future.result()
+        except Exception:
+            # Leave it to the caller to read the file again and report
+            # the error.
+            return None
+        finally:
+            with self._lock:
+                self._nbytes.pop(job, None)
+        if result is None:
+            return None
+        try:
+            changed = not np.array_equal(file_key(fname), key)
+        except OSError:
+            changed = True
+        if changed:
+            if self.discard is not None:
+                self.discard(result)
+            return None
+        return result
+
+    def clear(self):
+        for fname in list(self._jobs):
+            self._drop(self._jobs.pop(fname))
+
+    def close(self):
+        '''
+        Discard the files read ahead and stop the background thread
+        (without waiting for the file being read, if any).
+        '''
+        self.clear()
+        self._executor.shutdown(wait=False)
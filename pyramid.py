@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import numpy as np
+
+
+def file_key(fname):
+    '''
+    Return the size and modification time of a file. Data derived from
+    an image and cached to disk are stored with this key so that the
+    cache can be discarded if the image changes.
+    '''
+    stat = os.stat(fname)
+    return np.array([stat.st_size, stat.st_mtime])
+
+
+def downsample(yx, chunksize=1024):
+    '''
+    Halve the size of an image by averaging blocks of 2x2 pixels.
+
+    If the image has an odd number of rows or columns the last one is
+    dropped. The image is processed in blocks of 'chunksize' (output)
+    rows so that temporary arrays remain small even for very large or
+    memory-mapped images.
+    '''
+    h, w = yx.shape[0] // 2, yx.shape[1] // 2
+    out = np.empty((h, w), yx.dtype)
+    # Sum in a wider type to avoid overflow of integer images.
+    if yx.dtype.kind in 'ui' and yx.dtype.itemsize <= 2:
+        acc = np.int32
+    else:
+        acc = np.float64
+    for i in range(0, h, chunksize):
+        n = min(chunksize, h - i)
+        block = yx[2*i:2*(i+n), :2*w].reshape(n, 2, w, 2)
+        block = block.sum(axis=(1, 3), dtype=acc)
+        if acc is np.int32:
+            out[i:i+n] = block // 4
+        else:
+            out[i:i+n] = block / 4
+    return out
+
+
+class Pyramid(object):
+    '''
+    A multi-resolution pyramid of a single-channel image.
+
+    Level 0 is the image itself, and each further level is half the
+    size of the previous one along each dimension, until the image
+    fits in 'minsize' pixels.
+
+    If 'cache' is the name of a file the downsampled levels are read
+    from it, provided that it was created from the same version of the
+    image (as defined by 'key', see 'file_key'); otherwise they are
+    computed and saved to that file.
+    '''
+    def __init__(self, yx, minsize=256, cache=None, key=None):
+        self.levels = [yx]
+        if cache is not None and self._load(cache, key):
+            return
+        while max(self.levels[-1].shape) > minsize:
+            self.levels.append(downsample(self.levels[-1]))
+        if cache is not None:
+            self._save(cache, key)
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __getitem__(self, level):
+        return self.levels[level]
+
+    def _load(self, fname, key):
+        if not os.path.exists(fname):
+            return False
+        try:
+            with np.load(fname) as f:
+                if key is not None and not np.array_equal(f['key'], key):
+                    return False
+                n = len([name for name in f.files
+                         if name.startswith('level')])
+                self.levels += [f['level%i' % k] for k in range(1, n+1)]
+        except (IOError, OSError, KeyError, ValueError):
+            self.levels = self.levels[:1]
+            return False
+        return True
+
+    def _save(self, fname, key):
+        if key is None:
+            key = np.array([])
+        levels = {'level%i' % k: yx for k, yx in
+                  enumerate(self.levels[1:], 1)}
+        try:
+            np.savez(fname, key=key, **levels)
+        except (IOError, OSError):
+            # Caching is only an optimisation; carry on without it.
+            pass
+
+    def level_for(self, ax):
+        '''
+        Return the coarsest level whose resolution is at least that of
+        the screen, given the current limits and size of axes 'ax'.
+        '''
+        xmin, xmax = ax.get_xlim()
+        ymin, ymax = ax.get_ylim()
+        bbox = ax.bbox
+        if bbox.width < 1 or bbox.height < 1:
+            return len(self) - 1
+        # Image pixels per screen pixel.
+        scale = min(abs(xmax-xmin)/bbox.width, abs(ymax-ymin)/bbox.height)
+        if scale < 2:
+            return 0
+        level = int(np.floor(np.log2(scale)))
+        return min(level, len(self)-1)
+
@@ -0,0 +1,286 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Rasterisation of ROIs into a label image.
+
+Each ROI is filled (its pixels whose centre is inside it) by scanning
+its edges row by row, which takes time in proportion to the rows it
+spans and its number of vertices rather than to its area times its
+number of vertices, as testing each pixel would. Images can be
+rasterised at a reduced resolution ('scale' image pixels per label
+pixel along each axis) to save memory on large images.
+
+Where ROIs overlap, the label image holds only one of them, chosen by
+an overlap policy:
+
+    'smallest'  the ROI of smallest area, i.e. the innermost of nested
+                ROIs (as for selection, see RoiListModel.find_at).
+    'first'     the ROI added first.
+    'last'      the ROI added last.
+
+Assigning markers to ROIs, measuring ROIs and computing the intensity
+of an image in them then reduce to indexing the label image.
+'''
+
+import numpy as np
+
+OVERLAPPOLICIES = ('smallest', 'first', 'last')
+
+
+def polygon_mask(xy, box):
+    '''
+    Return a boolean array, True at the pixels (within rows r0:r1 and
+    columns c0:c1, where 'box' is (r0, r1, c0, c1)) whose centre is
+    inside the polygon of vertices 'xy' (even-odd rule). Pixel (i, j)
+    has its centre at x=j, y=i.
+    '''
+    r0, r1, c0, c1 = box
+    h, w = r1 - r0, c1 - c0
+    mask = np.zeros((h, w), bool)
+    if h <= 0 or w <= 0:
+        return mask
+    xy = np.asarray(xy, float)
+    x, y = xy[:, 0] - c0, xy[:, 1] - r0
+    dx, dy = np.roll(x, -1) - x, np.roll(y, -1) - y
+    # Rows whose centre is crossed by each edge, taking edges as
+    # half-open in y so that vertices are not counted twice.
+    lo = np.clip(np.ceil(np.minimum(y, y + dy)), 0, h).astype(int)
+    hi = np.clip(np.ceil(np.maximum(y, y + dy)), 0, h).astype(int)
+    n = hi - lo
+    if n.sum() == 0:
+        return mask
+    edges = np.repeat(np.arange(len(x)), n)
+    rows = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    rows += lo[edges]
+    xc = x[edges] + (rows - y[edges]) * dx[edges] / dy[edges]
+    # Pair the crossings of each row from left to right; the pixels
+    # between each pair are inside.
+    order = np.lexsort((xc, rows))
+    rows, xc = rows[order], xc[order]
+    start = np.clip(np.ceil(xc[0::2]), 0, w).astype(int)
+    stop = np.clip(np.ceil(xc[1::2]), 0, w).astype(int)
+    rows = rows[0::2]
+    edge = np.zeros((h, w + 1), np.int8)
+    np.add.at(edge, (rows, start), 1)
+    np.add.at(edge, (rows, stop), -1)
+    np.cumsum(edge, axis=1, dtype=np.int8, out=edge)
+    return edge[:, :w] > 0
+
+
+class RoiRaster(object):
+    '''
+    Label image of a set of ROIs, for an image of 'shape' (rows,
+    columns) rasterised at 1/'scale' of its resolution, with overlaps
+    resolved by policy 'overlap' (see the module's docstring).
+
+    ROIs are identified by a key (any hashable, e.g. their name). Each
+    is given a label (an integer from 1; 0 is no ROI), kept until the
+    raster is cleared; the label image is of 16 bits unless more labels
+    than fit have been given. The mask of each ROI is computed when first
+    needed and kept until the ROI is changed (see 'set'). The label
+    image is only updated when needed too, and then only in the region
+    of the ROIs changed since, so that editing a ROI does not require
+    rasterising all of them again.
+    '''
+    def __init__(self, shape, scale=1, overlap='smallest'):
+        if overlap not in OVERLAPPOLICIES:
+            raise ValueError('Invalid overlap policy: {}'.format(overlap))
+        self.shape = tuple(shape[:2])
+        self.scale = scale
+        self.overlap = overlap
+        self.label_shape = tuple(-(-n // scale) for n in self.shape)
+        self._labels = {}
+        self._keys = [None]
+        self._xy = {}
+        self._areas = {}
+        self._boxes = {}
+        self._masks = {}
+        self._image = None
+        self._dirty = []
+
+    def __len__(self):
+        return len(self._xy)
+
+    def __contains__(self, key):
+        return key in self._xy
+
+    def clear(self):
+        self._labels = {}
+        self._keys = [None]
+        self._xy = {}
+        self._areas = {}
+        self._boxes = {}
+        self._masks = {}
+        self._image = None
+        self._dirty = []
+
+    def _to_labels(self, xy):
+        '''
+        Return the coordinates 'xy' (x, y) in the label image.
+        '''
+        return (np.asarray(xy, float) + 0.5) / self.scale - 0.5
+
+    def _box(self, uv):
+        h, w = self.label_shape
+        (cmin, rmin), (cmax, rmax) = np.ceil(uv.min(0)), np.ceil(uv.max(0))
+        return (int(np.clip(rmin, 0, h)), int(np.clip(rmax, 0, h)),
+                int(np.clip(cmin, 0, w)), int(np.clip(cmax, 0, w)))
+
+    def set(self, key, xy):
+        '''
+        Add the ROI of vertices 'xy' with 'key', or replace the
+        vertices of the ROI with that key.
+        '''
+        if key in self._xy:
+            self._dirty.append(self._boxes[key])
+            self._masks.pop(key, None)
+        else:
+            self._labels[key] = len(self._keys)
+            self._keys.append(key)
+        uv = self._to_labels(xy)
+        u, v = uv.T
+        self._xy[key] = uv
+        self._areas[key] = abs(np.dot(u, np.roll(v, -1)) -
+                               np.dot(np.roll(u, -1), v)) / 2
+        self._boxes[key] = self._box(uv)
+        self._dirty.append(self._boxes[key])
+
+    def remove(self, key):
+        self._dirty.append(self._boxes.pop(key))
+        del self._xy[key]
+        del self._areas[key]
+        self._masks.pop(key, None)
+        self._keys[self._labels.pop(key)] = None
+
+    def label(self, key):
+        return self._labels[key]
+
+    def key(self, label):
+        '''
+        Return the key of the ROI with 'label', or None if there is no
+        such ROI.
+        '''
+        return self._keys[label]
+
+    def mask(self, key):
+        '''
+        Return the bounding box (r0, r1, c0, c1) of the ROI in the label
+        image, and its mask within it (regardless of overlaps).
+        '''
+        if key not in self._masks:
+            self._masks[key] = polygon_mask(self._xy[key], self._boxes[key])
+        return self._boxes[key], self._masks[key]
+
+    def _paint_order(self, keys):
+        if self.overlap == 'smallest':
+            return sorted(keys, key=self._areas.get, reverse=True)
+        return sorted(keys, key=self._labels.get,
+                      reverse=self.overlap == 'first')
+
+    def _dtype(self):
+        # The smallest type that holds every label given so far.
+        return np.uint16 if len(self._keys) <= 2**16 else np.uint32
+
+    def labels(self):
+        '''
+        Return the label image, updating first the regions of the ROIs
+        changed since it was last computed.
+        '''
+        if self._image is None or self._image.dtype != self._dtype():
+            self._image = np.zeros(self.label_shape, self._dtype())
+            self._dirty = [(0, self.label_shape[0], 0, self.label_shape[1])]
+        dirty, self._dirty = self._dirty, []
+        for r0, r1, c0, c1 in dirty:
+            if r0 >= r1 or c0 >= c1:
+                continue
+            self._image[r0:r1, c0:c1] = 0
+            keys = [key for key, (s0, s1, t0, t1) in self._boxes.items()
+                    if s0 < r1 and r0 < s1 and t0 < c1 and c0 < t1]
+            for key in self._paint_order(keys):
+                (s0, s1, t0, t1), mask = self.mask(key)
+                i0, i1 = max(r0, s0), min(r1, s1)
+                j0, j1 = max(c0, t0), min(c1, t1)
+                region = self._image[i0:i1, j0:j1]
+                region[mask[i0-s0:i1-s0, j0-t0:j1-t0]] = self._labels[key]
+        return self._image
+
+    def _pixels(self, xy):
+        '''
+        Return the rows and columns of the label image at the points
+        'xy', and whether each is within the image.
+        '''
+        xy = np.asarray(xy, float).reshape(-1, 2)
+        cols, rows = np.floor((xy + 0.5) / self.scale).astype(int).T
+        h, w = self.label_shape
+        inside = (rows >= 0) & (rows < h) & (cols >= 0) & (cols < w)
+        return rows, cols, inside
+
+    def assign(self, xy):
+        '''
+        Return the label of the ROI (see 'key') at each of the points
+        'xy' (x, y), or 0 where there is none.
+        '''
+        rows, cols, inside = self._pixels(xy)
+        labels = self.labels()
+        result = np.zeros(len(rows), labels.dtype)
+        result[inside] = labels[rows[inside], cols[inside]]
+        return result
+
+    def count(self, xy):
+        '''
+        Return a dictionary with the number of the points 'xy' (x, y)
+        assigned to each ROI.
+        '''
+        counts = np.bincount(self.assign(xy), minlength=len(self._keys))
+        return {key: int(counts[label])
+                for key, label in self._labels.items()}
+
+    def _region(self, key):
+        '''
+        Return the bounding box of the ROI and the pixels within it
+        assigned to it.
+        '''
+        r0, r1, c0, c1 = self._boxes[key]
+        return ((r0, r1, c0, c1),
+                self.labels()[r0:r1, c0:c1] == self._labels[key])
+
+    def area(self, key):
+        '''
+        Return the area (in image pixels) of the region assigned to the
+        ROI with 'key'.
+        '''
+        return self._region(key)[1].sum() * self.scale**2
+
+    def mean(self, key, yx):
+        '''
+        Return the mean of image 'yx' (of the raster's shape) in the
+        region assigned to the ROI with 'key', sampled at the centres
+        of the pixels of the label image, or nan if the region is
+        empty.
+        '''
+        (r0, r1, c0, c1), region = self._region(key)
+        s, k = self.scale, self.scale // 2
+        values = yx[r0*s+k:r1*s:s, c0*s+k:c1*s:s]
+        region = region[:values.shape[0], :values.shape[1]]
+        if not region.any():
+            return np.nan
+        return values[region].mean(dtype=float)
@@ -0,0 +1,291 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from spatial import GridIndex
+
+
+class RoiEditor(object):
+    '''
+    Edit the vertices of a ROI with the mouse: drag a vertex to move
+    it, click on an edge to add a vertex there (and drag it), and
+    right-click on a vertex to delete it.
+
+    Vertices are indexed by position (see spatial.GridIndex), so that
+    finding the vertex under the pointer does not require testing all
+    of them. While a ROI is edited its polygon is animated, as are the
+    handles drawn on its vertices: the rest of the figure is saved as
+    a background when the figure is drawn, and the polygon and handles
+    are then updated by blitting them over it. Handles are only drawn
+    if, at the current zoom, they would not overlap (the one under the
+    pointer is always drawn).
+
+    Edits are made through the RoiListModel 'rois' (see
+    RoiListModel.move_vertex), so that they can be undone. Edits made
+    otherwise (e.g. undoing) are followed through the model's
+    dataChanged signal.
+    '''
+    # Distance (in screen pixels) within which a click selects a vertex
+    # or an edge.
+    PICKRADIUS = 6
+    # Side (in image pixels) of the cells of the spatial index.
+    INDEXCELLSIZE = 32
+    HANDLECOLOUR = 'white'
+    HOVERCOLOUR = 'yellow'
+    HANDLESIZE = 4
+
+    def __init__(self, ax, rois):
+        self.ax = ax
+        self.canvas = ax.figure.canvas
+        self.rois = rois
+        self.roi = None
+        self.xy = None
+        self._spacing = 0
+        self.index = GridIndex(self.INDEXCELLSIZE)
+        self._background = None
+        self._drag = None
+        self._hover = None
+        self._editing = False
+        self._cids = []
+        self.handles = None
+        self.hover = None
+        rois.dataChanged.connect(self.on_data_changed)
+
+    def connect(self, roi):
+        '''
+        Start editing 'roi'.
+        '''
+        self.disconnect()
+        self.roi = roi
+        roi.polygon.set_animated(True)
+        self.handles, = self.ax.plot(
+                [], [], linestyle='none', marker='s', ms=self.HANDLESIZE,
+                mfc=self.HANDLECOLOUR, mec='black', animated=True)
+        self.hover, = self.ax.plot(
+                [], [], linestyle='none', marker='s', ms=2*self.HANDLESIZE,
+                mfc=self.HOVERCOLOUR, mec='black', animated=True)
+        self._load()
+        self._cids = [
+                self.canvas.mpl_connect('draw_event', self.on_draw),
+                self.canvas.mpl_connect('button_press_event',
+                                        self.on_press),
+                self.canvas.mpl_connect('button_release_event',
+                                        self.on_release),
+                self.canvas.mpl_connect('motion_notify_event',
+                                        self.on_motion)]
+        self.canvas.draw_idle()
+
+    def disconnect(self):
+        '''
+        Stop editing.
+        '''
+        for cid in self._cids:
+            self.canvas.mpl_disconnect(cid)
+        self._cids = []
+        if self.roi is not None:
+            self.roi.polygon.set_animated(False)
+            self.handles.remove()
+            self.hover.remove()
+            self.roi = None
+            self.canvas.draw_idle()
+        self.xy = None
+        self.index.clear()
+        self._background = None
+        self._drag = None
+        self._hover = None
+
+    def _load(self):
+        '''
+        Read the vertices of the ROI and index them.
+        '''
+        self.xy = self.roi.get_vertices()
+        self.index.clear()
+        self.index.insert(np.arange(len(self.xy)), self.xy)
+        self._spacing = np.median(np.hypot(*np.diff(self.xy, axis=0).T))
+        self.handles.set_data(self.xy[:, 0], self.xy[:, 1])
+        self._set_hover(None)
+
+    def on_data_changed(self, *args):
+        if self.roi is None or self._editing:
+            return
+        self._load()
+        self.blit()
+
+    def on_draw(self, event):
+        '''
+        Save the canvas as background, and draw the ROI and handles,
+        after the figure has been drawn.
+        '''
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        self.ax.draw_artist(self.roi.polygon)
+        size = self.HANDLESIZE * self.ax.figure.dpi / 72
+        if self._spacing > 2 * size * self.pixel_size():
+            self.ax.draw_artist(self.handles)
+        self.ax.draw_artist(self.hover)
+
+    def blit(self):
+        if self._background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self._background)
+        self._draw_artists()
+        self.canvas.blit(self.ax.bbox)
+
+    def pixel_size(self):
+        '''
+        Return the size of a screen pixel in data coordinates at the
+        current zoom.
+        '''
+        xmin, xmax = self.ax.get_xlim()
+        return abs(xmax - xmin) / self.ax.bbox.width
+
+    def pick_radius(self):
+        return self.PICKRADIUS * self.pixel_size()
+
+    def nearest_vertex(self, x, y, radius):
+        '''
+        Return the index of the vertex nearest to 'x', 'y' that is
+        within 'radius' of it, or None if there is none.
+        '''
+        ids = self.index.query(x-radius, y-radius, x+radius, y+radius)
+        if not ids:
+            return None
+        ids = np.array(ids)
+        dist = np.hypot(*(self.xy[ids] - (x, y)).T)
+        k = np.argmin(dist)
+        return ids[k] if dist[k] <= radius else None
+
+    def nearest_edge(self, x, y, radius):
+        '''
+        Return the index of the vertex that ends the edge nearest to
+        'x', 'y' (i.e. where a vertex would be inserted) and the point
+        of that edge nearest to 'x', 'y', or None if no edge is within
+        'radius'.
+        '''
+        a = self.xy
+        ab = np.roll(a, -1, axis=0) - a
+        length2 = (ab**2).sum(axis=1)
+        t = ((x, y) - a) * ab
+        t = np.clip(t.sum(axis=1) / np.where(length2 > 0, length2, 1),
+                    0, 1)
+        points = a + t[:, None] * ab
+        dist = np.hypot(*(points - (x, y)).T)
+        k = np.argmin(dist)
+        if dist[k] > radius:
+            return None
+        return k + 1, points[k]
+
+    def _set_hover(self, i):
+        self._hover = i
+        if i is None:
+            self.hover.set_data([], [])
+        else:
+            self.hover.set_data([self.xy[i, 0]], [self.xy[i, 1]])
+
+    def _edit(self, function, *args):
+        '''
+        Make an edit through the model, updating the vertices only as
+        needed rather than reloading them.
+        '''
+        self._editing = True
+        try:
+            function(self.rois.find(self.roi.name), *args)
+        finally:
+            self._editing = False
+
+    def on_press(self, event):
+        if self.canvas.widgetlock.locked():
+            return
+        if event.inaxes is None:
+            return
+        x, y = event.xdata, event.ydata
+        radius = self.pick_radius()
+        i = self.nearest_vertex(x, y, radius)
+        if event.button == 3:
+            # Delete the vertex, unless that would not leave a polygon.
+            if i is not None and len(self.xy) > 3:
+                self._edit(self.rois.delete_vertex, i)
+                self._load()
+                self.blit()
+            return
+        if event.button != 1:
+            return
+        if i is None:
+            edge = self.nearest_edge(x, y, radius)
+            if edge is None:
+                return
+            # Insert the vertex only on screen while it is dragged; it
+            # is inserted through the model, where it is left, when the
+            # mouse button is released, so that inserting and moving it
+            # are undone at once.
+            i, point = edge
+            self.roi.set_vertices(np.insert(self.xy, i, point, axis=0))
+            self._load()
+            self._drag = i, None
+        else:
+            self._drag = i, self.xy[i].copy()
+        self._set_hover(i)
+        self.blit()
+
+    def on_motion(self, event):
+        if event.inaxes is None:
+            return
+        if self._drag is None:
+            # Highlight the vertex under the pointer.
+            i = self.nearest_vertex(event.xdata, event.ydata,
+                                    self.pick_radius())
+            if i != self._hover:
+                self._set_hover(i)
+                self.blit()
+            return
+        i = self._drag[0]
+        self.xy[i] = event.xdata, event.ydata
+        self.roi.set_vertices(self.xy)
+        self.handles.set_data(self.xy[:, 0], self.xy[:, 1])
+        self._set_hover(i)
+        self.blit()
+
+    def on_release(self, event):
+        if self._drag is None:
+            return
+        i, old = self._drag
+        self._drag = None
+        new = self.xy[i].copy()
+        if old is None:
+            self.roi.set_vertices(np.delete(self.xy, i, axis=0))
+            self._edit(self.rois.insert_vertex, i, new)
+            self._load()
+            self._set_hover(i)
+            self.blit()
+            return
+        if np.array_equal(new, old):
+            return
+        # Put the vertex back, and move it through the model so that
+        # the move can be undone.
+        self.roi.set_vertices(np.concatenate([self.xy[:i], [old],
+                                              self.xy[i+1:]]))
+        self._edit(self.rois.move_vertex, i, new)
+        self.index.remove([i], [old])
+        self.index.insert([i], [new])
+        self.blit()
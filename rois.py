@@ -18,12 +18,63 @@
 # You should have received a copy of the GNU General Public License
 # along with roimanager. If not, see <http://www.gnu.org/licenses/>.
 
+from functools import partial
+
+import numpy as np
 from PyQt5.QtCore import (Qt, QVariant, QModelIndex)
 from PyQt5.QtCore import (QAbstractListModel)
 # import h5py
 # import bisect
 from matplotlib.patches import Polygon
 
+from spatial import BoxIndex
+
+
+def simplify(xy, tolerance):
+    '''
+    Simplify a polygon (an array of vertices of shape (N, 2)) by the
+    Douglas-Peucker algorithm: the vertices kept are such that no
+    vertex removed is farther than 'tolerance' from the simplified
+    outline.
+
+    The polygon is first split into two lines, at its first vertex and
+    at the vertex farthest from it. Then, instead of recursing into
+    each segment of the simplified outline, all segments are split
+    together, at the vertex farthest from each, until no vertex is
+    farther than 'tolerance'. That takes as many passes as the depth
+    of the recursion, each vectorised over all vertices.
+    '''
+    xy = np.asarray(xy, float)
+    n = len(xy)
+    if n < 4 or not tolerance:
+        return xy
+    keep = np.zeros(n, bool)
+    keep[[0, n-1]] = True
+    keep[np.argmax(np.hypot(*(xy - xy[0]).T))] = True
+    points = np.arange(n)
+    while True:
+        kept = np.flatnonzero(keep)
+        # Segment of the simplified outline that each vertex is in.
+        seg = np.minimum(np.searchsorted(kept, points, 'right') - 1,
+                         len(kept) - 2)
+        a, b = xy[kept[seg]], xy[kept[seg+1]]
+        ab = b - a
+        length2 = (ab**2).sum(axis=1)
+        t = ((xy - a) * ab).sum(axis=1) / np.where(length2 > 0, length2, 1)
+        t = np.clip(t, 0, 1)
+        dist = np.hypot(*(xy - a - t[:, None] * ab).T)
+        dist[keep] = 0
+        segmax = np.maximum.reduceat(dist, kept[:-1])
+        if not (segmax > tolerance).any():
+            break
+        # Keep the farthest vertex (the first, if tied) of each segment
+        # that is too far.
+        far = np.flatnonzero((dist == segmax[seg]) & (dist > tolerance))
+        first = np.ones(len(far), bool)
+        first[1:] = seg[far][1:] != seg[far][:-1]
+        keep[far[first]] = True
+    return xy[keep]
+
 
 class Roi(object):
     def __init__(self, xy, name, colour, linewidth=None):
@@ -58,17 +109,62 @@ class Roi(object):
     def get_name(self):
         return self.name
 
-    def set_xy(self):
-        return self.polygon.set_xy()
+    def set_xy(self, xy):
+        return self.polygon.set_xy(xy)
 
     def get_xy(self):
         return self.polygon.get_xy()
 
+    def get_vertices(self):
+        '''
+        Return a copy of the vertices, without the last one that closes
+        the polygon (and is the same as the first).
+        '''
+        return self.polygon.get_xy()[:-1].copy()
+
+    def set_vertices(self, xy):
+        self.polygon.set_xy(xy)
+
     def get_polygon(self):
         return self.polygon
 
+    def get_bbox(self):
+        '''
+        Return the bounding box (xmin, ymin, xmax, ymax) of the ROI.
+        '''
+        xy = self.get_xy()
+        return tuple(xy.min(axis=0)) + tuple(xy.max(axis=0))
+
+    def get_area(self):
+        x, y = self.get_xy().T
+        return abs(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1])) / 2
+
+    def contains(self, x, y):
+        return self.polygon.get_path().contains_point((x, y))
+
 
 class RoiListModel(QAbstractListModel):
+    '''
+    List of ROIs, with unique names.
+
+    ROIs are also indexed by name ('_rows' maps each name to its row),
+    so that finding a ROI by name and checking whether a name is in use
+    do not require searching the list. For each name that has been
+    made unique by appending a number to it, '_suffixes' keeps the next
+    number to try, so that adding many ROIs with the same name does
+    not try all the numbers used before each time.
+
+    The bounding boxes of the ROIs are indexed by position (see
+    spatial.BoxIndex), so that finding the ROI at a point (see
+    'find_at') only tests the polygons of the ROIs whose bounding box
+    contains it.
+
+    If 'raster' is set (see raster.RoiRaster), the ROIs are kept in it,
+    by Roi, as they are added, edited and removed.
+    '''
+    # Side (in image pixels) of the cells of the spatial index.
+    INDEXCELLSIZE = 512
+
     def __init__(self):
         super(RoiListModel, self).__init__()
         # '_rois' will hold the list of all ROIs. Each
@@ -76,14 +172,26 @@ class RoiListModel(QAbstractListModel):
         # with two elements, the name (used for sorting)
         # and the roi itself.
         self._rois = []
+        self._rows = {}
+        self._suffixes = {}
+        self._boxes = BoxIndex(self.INDEXCELLSIZE)
         # A flag to keep track of unsaved changes.
         self.is_dirty = False
+        # If set (see journal.Journal), renaming ROIs and editing their
+        # vertices are recorded there so that they can be undone.
+        self.journal = None
+        self.raster = None
 
     def clear(self):
         while len(self._rois) > 0:
             roi = self._rois.pop()
             roi[1].polygon.remove()
         self._rois = []
+        self._rows = {}
+        self._suffixes = {}
+        self._boxes.clear()
+        if self.raster is not None:
+            self.raster.clear()
         self.is_dirty = False
         # self.listRoi.clearSelection()
 
@@ -103,6 +211,35 @@ class RoiListModel(QAbstractListModel):
         for roi in self._rois:
             yield roi[1]
 
+    def __contains__(self, name):
+        return name in self._rows
+
+    def find(self, name):
+        '''
+        Return the row of the ROI named 'name', or None if there is no
+        such ROI.
+        '''
+        return self._rows.get(name)
+
+    def find_at(self, x, y):
+        '''
+        Return the row of the ROI that contains the point 'x', 'y', or
+        None if there is none. If several ROIs contain it (nested
+        structures), that of the smallest (innermost) is returned.
+        '''
+        rois = [roi for roi in self._boxes.query(x, y)
+                if roi.contains(x, y)]
+        if not rois:
+            return None
+        return self.find(min(rois, key=Roi.get_area).name)
+
+    def _reindex(self, start=0):
+        '''
+        Update the rows of the ROIs from row 'start' on.
+        '''
+        for row in range(start, len(self._rois)):
+            self._rows[self._rois[row][0]] = row
+
     def flags(self, index):
         if not index.isValid():
             return Qt.ItemIsEnabled
@@ -116,20 +253,84 @@ class RoiListModel(QAbstractListModel):
                 return False
             # Make sure new name is unique.
             name = self.get_unique_name(value)
-            roi_item = self._rois[index.row()]
-            # Change name in ROI collection.
-            roi_item[0] = name
-            # Rename roi object.
-            roi_item[1].set_name(name)
-            self.is_dirty = True
+            self.rename(index.row(), name)
             return True
         return False
 
+    def rename(self, row, name):
+        roi_item = self._rois[row]
+        if self.journal is not None:
+            self.journal.record(partial(self.rename, row, roi_item[0]),
+                                partial(self.rename, row, name))
+        # Change name in ROI collection.
+        del self._rows[roi_item[0]]
+        self._rows[name] = row
+        roi_item[0] = name
+        # Rename roi object.
+        roi_item[1].set_name(name)
+        self.is_dirty = True
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+    def get_roi(self, row):
+        return self._rois[row][1]
+
+    def _set_vertices(self, row, xy):
+        roi = self._rois[row][1]
+        roi.set_vertices(xy)
+        self._boxes.insert(roi, roi.get_bbox())
+        if self.raster is not None:
+            self.raster.set(roi, roi.get_xy())
+        self.is_dirty = True
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+    def move_vertex(self, row, i, xy):
+        '''
+        Move vertex 'i' of the ROI in 'row' to 'xy'.
+        '''
+        vertices = self._rois[row][1].get_vertices()
+        old = vertices[i].copy()
+        vertices[i] = xy
+        if self.journal is not None:
+            self.journal.record(partial(self.move_vertex, row, i, old),
+                                partial(self.move_vertex, row, i,
+                                        vertices[i].copy()))
+        self._set_vertices(row, vertices)
+
+    def insert_vertex(self, row, i, xy):
+        '''
+        Insert a vertex at 'xy' before vertex 'i' of the ROI in 'row'.
+        '''
+        vertices = self._rois[row][1].get_vertices()
+        vertices = np.insert(vertices, i, xy, axis=0)
+        if self.journal is not None:
+            self.journal.record(partial(self.delete_vertex, row, i),
+                                partial(self.insert_vertex, row, i,
+                                        vertices[i].copy()))
+        self._set_vertices(row, vertices)
+
+    def delete_vertex(self, row, i):
+        '''
+        Delete vertex 'i' of the ROI in 'row'.
+        '''
+        vertices = self._rois[row][1].get_vertices()
+        if self.journal is not None:
+            self.journal.record(partial(self.insert_vertex, row, i,
+                                        vertices[i].copy()),
+                                partial(self.delete_vertex, row, i))
+        self._set_vertices(row, np.delete(vertices, i, axis=0))
+
     def removeRow(self, position, index=QModelIndex()):
         if len(self._rois) == 0:
             return False
         self.beginRemoveRows(QModelIndex(), position, position)
         roi = self._rois.pop(position)
+        del self._rows[roi[0]]
+        self._boxes.remove(roi[1])
+        if self.raster is not None:
+            self.raster.remove(roi[1])
+        self._reindex(position)
         roi[1].polygon.remove()
         self.endRemoveRows()
         self.is_dirty = True
@@ -143,29 +344,35 @@ class RoiListModel(QAbstractListModel):
         and a number are appended to that name to make it
         unique.
         '''
-        # Names currently in use.
-        names = [roi[0] for roi in self._rois]
         # If 'name' does not already exist return that name
         # and exit.
-        if name not in names:
+        if name not in self._rows:
             return name
         # If it does exist, iterate until we create one which
-        # does not exist.
-        newname = name
-        n = 1
-        while newname in names:
-            newname = '{}_{}'.format(name, n)
+        # does not exist, starting after the last number used.
+        n = self._suffixes.get(name, 1)
+        newname = '{}_{}'.format(name, n)
+        while newname in self._rows:
             n += 1
+            newname = '{}_{}'.format(name, n)
+        self._suffixes[name] = n + 1
         return newname
 
-    def insertRow(self, roi):
+    def insertRow(self, roi, position=None):
         # New roi name should be unique.
         name = self.get_unique_name(roi.name)
         roi.set_name(name)
-        # Add roi to list.
-        position = self.rowCount()
+        # Add roi to list, at the end unless 'position' is given.
+        if position is None:
+            position = self.rowCount()
         self.beginInsertRows(QModelIndex(), position, position)
         self._rois.insert(position, [name, roi])
+        self._rows[name] = position
+        self._boxes.insert(roi, roi.get_bbox())
+        if self.raster is not None:
+            self.raster.set(roi, roi.get_xy())
+        if position < len(self._rois) - 1:
+            self._reindex(position)
         self.endInsertRows()
         # TODO: Are these lines necessary in PyQt5?
         # index = self.index(position)
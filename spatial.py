@@ -0,0 +1,152 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+from collections import defaultdict
+
+import numpy as np
+
+
+class GridIndex(object):
+    '''
+    A uniform grid over the plane used to find the points near a
+    location without testing all of them.
+
+    Points are stored by id (any hashable, e.g. an integer) in the
+    square cell of side 'cellsize' that contains them. Inserting or
+    removing a point only touches its cell, and a query only looks at
+    the cells that intersect the area queried, so that the cost of
+    both does not depend on the total number of points.
+    '''
+    def __init__(self, cellsize=64):
+        self.cellsize = cellsize
+        self._cells = defaultdict(set)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _cell_ids(self, xy):
+        cells = np.floor_divide(np.reshape(xy, (-1, 2)), self.cellsize)
+        return [tuple(cell) for cell in cells.astype(int).tolist()]
+
+    def insert(self, ids, xy):
+        '''
+        Add points with ids 'ids' at coordinates 'xy' (shape (N, 2)).
+        '''
+        for id_, cell in zip(ids, self._cell_ids(xy)):
+            self._cells[cell].add(id_)
+        self._size += len(ids)
+
+    def remove(self, ids, xy):
+        '''
+        Remove points 'ids', which must have been inserted at 'xy'.
+        '''
+        for id_, cell in zip(ids, self._cell_ids(xy)):
+            ids_cell = self._cells[cell]
+            ids_cell.discard(id_)
+            if not ids_cell:
+                del self._cells[cell]
+        self._size -= len(ids)
+
+    def clear(self):
+        self._cells.clear()
+        self._size = 0
+
+    def query(self, xmin, ymin, xmax, ymax):
+        '''
+        Return a list of the ids of all points in the cells that
+        intersect the rectangle (xmin, ymin)-(xmax, ymax). This may
+        include points just outside of it.
+        '''
+        (i0, j0), (i1, j1) = self._cell_ids([[xmin, ymin], [xmax, ymax]])
+        ids = []
+        if (i1-i0+1) * (j1-j0+1) > len(self._cells):
+            # Large area: fewer cells are occupied than intersected.
+            for (i, j), ids_cell in self._cells.items():
+                if i0 <= i <= i1 and j0 <= j <= j1:
+                    ids.extend(ids_cell)
+        else:
+            for i in range(i0, i1+1):
+                for j in range(j0, j1+1):
+                    ids_cell = self._cells.get((i, j))
+                    if ids_cell:
+                        ids.extend(ids_cell)
+        return ids
+
+
+class BoxIndex(object):
+    '''
+    A uniform grid over the plane used to find the rectangles (e.g.
+    the bounding boxes of polygons) that contain a point without
+    testing all of them.
+
+    Rectangles are stored by id (any hashable) in every square cell of
+    side 'cellsize' that they overlap, so that a query only tests the
+    rectangles in the cell that contains the point.
+    '''
+    def __init__(self, cellsize=512):
+        self.cellsize = cellsize
+        self._cells = defaultdict(set)
+        self._boxes = {}
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def _cell_ids(self, box):
+        xmin, ymin, xmax, ymax = box
+        i0, j0, i1, j1 = (int(v // self.cellsize)
+                          for v in (xmin, ymin, xmax, ymax))
+        return [(i, j) for i in range(i0, i1+1) for j in range(j0, j1+1)]
+
+    def insert(self, id_, box):
+        '''
+        Add the rectangle 'box' (xmin, ymin, xmax, ymax) with id 'id_',
+        replacing the rectangle with that id if there was one.
+        '''
+        if id_ in self._boxes:
+            self.remove(id_)
+        self._boxes[id_] = box
+        for cell in self._cell_ids(box):
+            self._cells[cell].add(id_)
+
+    def remove(self, id_):
+        box = self._boxes.pop(id_)
+        for cell in self._cell_ids(box):
+            ids_cell = self._cells[cell]
+            ids_cell.discard(id_)
+            if not ids_cell:
+                del self._cells[cell]
+
+    def clear(self):
+        self._cells.clear()
+        self._boxes.clear()
+
+    def query(self, x, y):
+        '''
+        Return a list of the ids of the rectangles that contain the
+        point 'x', 'y'.
+        '''
+        cell = (int(x // self.cellsize), int(y // self.cellsize))
+        ids = []
+        for id_ in self._cells.get(cell, ()):
+            xmin, ymin, xmax, ymax = self._boxes[id_]
+            if xmin <= x <= xmax and ymin <= y <= ymax:
+                ids.append(id_)
+        return ids
@@ -0,0 +1,155 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import numpy as np
+
+from pyramid import file_key
+
+# Number of histogram bins for images other than 8- or 16-bit.
+NBINS = 4096
+
+
+class ChannelStats(object):
+    '''
+    Intensity statistics of one channel.
+
+    'counts[i]' is the number of pixels with values in the range
+    [edges[i], edges[i+1]). 8- and 16-bit images have one bin per
+    possible value, so that their histogram is exact.
+    '''
+    def __init__(self, counts, edges, vmin, vmax):
+        self.counts = counts
+        self.edges = edges
+        self.min = vmin
+        self.max = vmax
+
+    def percentile(self, q):
+        '''
+        Return the q-th percentile (0-100; a number or a sequence) of
+        the pixel values, to the resolution of the histogram.
+        '''
+        cumsum = np.cumsum(self.counts)
+        indx = np.searchsorted(cumsum, np.asarray(q) / 100 * cumsum[-1])
+        indx = np.minimum(indx, len(self.counts) - 1)
+        return np.clip(self.edges[indx], self.min, self.max)
+
+    def auto_range(self, saturated=0.35):
+        '''
+        Return a display range (min, max) that leaves 'saturated'
+        percent of the pixels out of range, half at each end (as with
+        ImageJ's "Auto" contrast).
+        '''
+        rmin, rmax = self.percentile([saturated/2, 100 - saturated/2])
+        if rmin >= rmax:
+            rmin, rmax = self.min, self.max
+        return rmin, rmax
+
+
+def channel_stats(yx, chunksize=1024):
+    '''
+    Compute the statistics of a channel, reading it in blocks of
+    'chunksize' rows so that no large temporary arrays are created.
+    '''
+    chunks = range(0, yx.shape[0], chunksize)
+    if yx.dtype in (np.uint8, np.uint16):
+        nbins = np.iinfo(yx.dtype).max + 1
+        counts = np.zeros(nbins, np.int64)
+        for i in chunks:
+            counts += np.bincount(yx[i:i+chunksize].ravel(),
+                                  minlength=nbins)
+        edges = np.arange(nbins + 1)
+        nonzero = np.flatnonzero(counts)
+        vmin, vmax = nonzero[0], nonzero[-1]
+    else:
+        vmin = min(yx[i:i+chunksize].min() for i in chunks)
+        vmax = max(yx[i:i+chunksize].max() for i in chunks)
+        edges = np.linspace(vmin, vmax, NBINS + 1)
+        counts = np.zeros(NBINS, np.int64)
+        for i in chunks:
+            counts += np.histogram(yx[i:i+chunksize], edges)[0]
+    return ChannelStats(counts, edges, vmin, vmax)
+
+
+class StatsCache(object):
+    '''
+    Statistics of the channels of an image.
+
+    Statistics are computed the first time that they are requested for
+    a channel and, if 'save' is True, saved to a file next to the image
+    (same name, extension '.stats.npz'). That file is only used as long
+    as the image's size and modification time do not change.
+
+    Channels with more than 'maxpixels' pixels are subsampled (taking
+    every n-th row and column) so that no more than that number of
+    pixels is read; their statistics are then approximate.
+    '''
+    def __init__(self, fname, save=True, maxpixels=None):
+        self.fname = os.path.splitext(fname)[0] + '.stats.npz'
+        self.key = file_key(fname)
+        self.save = save
+        self.maxpixels = maxpixels
+        self._stats = {}
+        self._load()
+
+    def get(self, chan):
+        '''
+        Return the statistics of channel 'chan' (an ijtiff.Channel).
+        '''
+        if chan.n not in self._stats:
+            yx = chan.yx
+            if self.maxpixels is not None and yx.size > self.maxpixels:
+                step = int(np.ceil(np.sqrt(yx.size / self.maxpixels)))
+                yx = yx[::step, ::step]
+            self._stats[chan.n] = channel_stats(yx)
+            if self.save:
+                self._save()
+        return self._stats[chan.n]
+
+    def _load(self):
+        if not os.path.exists(self.fname):
+            return
+        try:
+            with np.load(self.fname) as f:
+                if not np.array_equal(f['key'], self.key):
+                    return
+                for name in f.files:
+                    if not name.endswith('_counts'):
+                        continue
+                    prefix = name[:-len('counts')]
+                    n = int(prefix[1:-1])
+                    vmin, vmax = f[prefix+'range']
+                    self._stats[n] = ChannelStats(
+                            f[prefix+'counts'], f[prefix+'edges'],
+                            vmin, vmax)
+        except (IOError, OSError, KeyError, ValueError):
+            self._stats = {}
+
+    def _save(self):
+        arrays = {'key': self.key}
+        for n, stats in self._stats.items():
+            arrays['c%i_counts' % n] = stats.counts
+            arrays['c%i_edges' % n] = stats.edges
+            arrays['c%i_range' % n] = np.array([stats.min, stats.max])
+        try:
+            np.savez(self.fname, **arrays)
+        except (IOError, OSError):
+            # Caching is only an optimisation; carry on without it.
+            pass
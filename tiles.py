@@ -0,0 +1,293 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+
+import numpy as np
+from matplotlib.colors import to_rgba
+from matplotlib.image import AxesImage
+
+# Size (in pixels of the pyramid level) of the side of each tile.
+TILESIZE = 256
+
+
+class TileCache(object):
+    '''
+    A least-recently-used cache of rendered tiles.
+
+    Tiles are stored under any hashable key; the oldest tiles are
+    discarded once the total size of the cached tiles exceeds
+    'maxbytes'.
+    '''
+    def __init__(self, maxbytes=256*2**20):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._tiles = OrderedDict()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, key):
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+        return tile
+
+    def put(self, key, tile):
+        if key in self._tiles:
+            self.nbytes -= self._tiles.pop(key).nbytes
+        self._tiles[key] = tile
+        self.nbytes += tile.nbytes
+        while self.nbytes > self.maxbytes and len(self._tiles) > 1:
+            _, old = self._tiles.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def clear(self):
+        self._tiles.clear()
+        self.nbytes = 0
+
+
+def tile_range(lo, hi, factor, size, tilesize=TILESIZE):
+    '''
+    Return the first and last (exclusive) tiles along one dimension
+    that intersect the interval (lo, hi), given in full-resolution
+    coordinates, of a pyramid level of 'size' pixels that is 'factor'
+    times smaller than the full-resolution image.
+    '''
+    first = int(np.floor((lo + 0.5) / factor)) // tilesize
+    last = int(np.ceil((hi + 0.5) / factor) - 1) // tilesize + 1
+    ntiles = -(-size // tilesize)
+    return max(first, 0), min(last, ntiles)
+
+
+def axes_pixels(ax):
+    '''
+    Return the position (x0, y0, from the bottom left of the canvas)
+    and size (width, height) of axes 'ax', in whole screen pixels.
+    '''
+    bbox = ax.bbox
+    return tuple(int(round(v)) for v in
+                 (bbox.x0, bbox.y0, bbox.width, bbox.height))
+
+
+def axes_background(ax):
+    '''
+    Return the colour (RGBA, uint8) shown where nothing is drawn in
+    axes 'ax'.
+    '''
+    if ax.axison:
+        colour = ax.patch.get_facecolor()
+    else:
+        colour = ax.figure.get_facecolor()
+    return (np.array(to_rgba(colour)) * 255).astype(np.uint8)
+
+
+def blit_pixels(ax, pixels):
+    '''
+    Show 'pixels' (an RGBA array of the size of axes 'ax' in screen
+    pixels, rows from the top) as the contents of the axes, with all
+    lines, patches and collections (e.g. ROIs and markers) drawn over
+    it, without drawing the figure.
+    '''
+    x0, y0, _, _ = axes_pixels(ax)
+    canvas = ax.figure.canvas
+    renderer = canvas.get_renderer()
+    gc = renderer.new_gc()
+    # Images are drawn with their first row at the bottom.
+    renderer.draw_image(gc, x0, y0, np.ascontiguousarray(pixels[::-1]))
+    gc.restore()
+    artists = list(ax.patches) + list(ax.lines) + list(ax.collections)
+    for artist in sorted(artists, key=lambda a: a.get_zorder()):
+        ax.draw_artist(artist)
+    canvas.blit(ax.bbox)
+
+
+class TiledImage(AxesImage):
+    '''
+    An image that, each time that it is drawn, renders only the part of
+    an image pyramid that is in view.
+
+    The pyramid level that matches the resolution of the screen is
+    split into square tiles of TILESIZE pixels. Only the tiles that
+    intersect the current axes limits are colour-mapped and assembled
+    into the array that matplotlib draws. Rendered tiles are kept in a
+    TileCache (which may be shared by several images) under the key
+    (name, level, tile, clim, cmap), so that panning, zooming back, or
+    returning to a previous display range reuses them.
+
+    Display range and colourmap are set as with any other image, with
+    set_clim and set_cmap. Subclasses that render tiles differently
+    override 'render_tile' and 'view_key'.
+
+    If 'caching' is False, tiles are still looked up in the cache but
+    newly rendered ones are not added to it. This is meant for settings
+    that are shown only briefly (e.g. while dragging a slider), whose
+    tiles would otherwise push useful ones out of the cache.
+    '''
+    def __init__(self, ax, pyramid, cache=None, name=None, **kwargs):
+        super(TiledImage, self).__init__(ax, **kwargs)
+        self.pyramid = pyramid
+        self.cache = TileCache() if cache is None else cache
+        self.name = name
+        self.caching = True
+        self._view = None
+        # Start with an empty view; tiles are rendered when drawn.
+        self.set_data(np.zeros((1, 1, 4), np.uint8))
+
+    def get_image_extent(self):
+        '''
+        Return the extent of the full image (not only of the part in
+        view, which is what get_extent returns).
+        '''
+        h, w = self.pyramid[0].shape[:2]
+        return (-0.5, w - 0.5, h - 0.5, -0.5)
+
+    def view_key(self):
+        '''
+        Return the display settings that rendered tiles depend on.
+        '''
+        # Colour-mapping tiles separately requires a fixed display
+        # range; if none has been set use that of the smallest level.
+        if self.norm.vmin is None or self.norm.vmax is None:
+            self.norm.autoscale_None(self.pyramid[-1])
+        return (self.norm.vmin, self.norm.vmax, self.cmap.name)
+
+    def render_tile(self, level, row, col):
+        '''
+        Return tile ('row', 'col') of pyramid 'level' as an RGBA array
+        of type uint8.
+        '''
+        key = (self.name, level, (row, col)) + self.view_key()
+        tile = self.cache.get(key)
+        if tile is None:
+            yx = self.pyramid[level]
+            tile = yx[row*TILESIZE:(row+1)*TILESIZE,
+                      col*TILESIZE:(col+1)*TILESIZE]
+            tile = self.to_rgba(tile, bytes=True)
+            if self.caching:
+                self.cache.put(key, tile)
+        return tile
+
+    def render_view(self, level, rows, cols):
+        '''
+        Assemble the tiles in the range 'rows', 'cols' of pyramid
+        'level' into a single array.
+        '''
+        yx = self.pyramid[level]
+        y0, x0 = rows[0]*TILESIZE, cols[0]*TILESIZE
+        y1 = min(rows[1]*TILESIZE, yx.shape[0])
+        x1 = min(cols[1]*TILESIZE, yx.shape[1])
+        view = None
+        for row in range(*rows):
+            for col in range(*cols):
+                tile = self.render_tile(level, row, col)
+                if view is None:
+                    view = np.empty((y1-y0, x1-x0) + tile.shape[2:],
+                                    np.uint8)
+                y, x = row*TILESIZE - y0, col*TILESIZE - x0
+                view[y:y+tile.shape[0], x:x+tile.shape[1]] = tile
+        return view, (y0, y1, x0, x1)
+
+    def update_view(self):
+        '''
+        Render the part of the image that is within the axes limits,
+        if it has changed since the last time.
+        '''
+        if self.pyramid is None:
+            return False
+        level = self.pyramid.level_for(self.axes)
+        yx = self.pyramid[level]
+        factor = 2**level
+        xlim = sorted(self.axes.get_xlim())
+        ylim = sorted(self.axes.get_ylim())
+        rows = tile_range(ylim[0], ylim[1], factor, yx.shape[0])
+        cols = tile_range(xlim[0], xlim[1], factor, yx.shape[1])
+        if rows[0] >= rows[1] or cols[0] >= cols[1]:
+            # Nothing in view.
+            return False
+        view = (level, rows, cols) + self.view_key()
+        if view == self._view:
+            return True
+        data, (y0, y1, x0, x1) = self.render_view(level, rows, cols)
+        self.set_data(data)
+        self.set_extent((x0*factor - 0.5, x1*factor - 0.5,
+                         y1*factor - 0.5, y0*factor - 0.5))
+        self._view = view
+        return True
+
+    def render_pixels(self, xlim, ylim, width, height,
+                      background=(0, 0, 0, 0)):
+        '''
+        Return the image as it would be shown with axes limits 'xlim',
+        'ylim' on 'width' x 'height' screen pixels, as an RGBA array of
+        type uint8 with rows from the top. Image pixels are sampled
+        with nearest-neighbour interpolation from the pyramid level
+        currently in view, and screen pixels outside the image are set
+        to 'background'.
+
+        This is much cheaper than drawing the image, and is meant for
+        temporary views (e.g. while panning) that are drawn directly on
+        the canvas.
+        '''
+        pixels = np.empty((height, width, 4), np.uint8)
+        pixels[...] = background
+        if self.pyramid is None or width < 1 or height < 1:
+            return pixels
+        level = self.pyramid.level_for(self.axes)
+        factor = 2**level
+        yx = self.pyramid[level]
+        # Pyramid level pixel at the centre of each screen pixel.
+        x = xlim[0] + (np.arange(width) + 0.5)*(xlim[1] - xlim[0])/width
+        y = ylim[1] + (np.arange(height) + 0.5)*(ylim[0] - ylim[1])/height
+        cols = np.floor((x + 0.5) / factor).astype(int)
+        rows = np.floor((y + 0.5) / factor).astype(int)
+        incols = np.flatnonzero((cols >= 0) & (cols < yx.shape[1]))
+        inrows = np.flatnonzero((rows >= 0) & (rows < yx.shape[0]))
+        if len(incols) == 0 or len(inrows) == 0:
+            return pixels
+        cols, rows = cols[incols], rows[inrows]
+        tiles = ((rows.min() // TILESIZE, rows.max() // TILESIZE + 1),
+                 (cols.min() // TILESIZE, cols.max() // TILESIZE + 1))
+        view, (y0, _, x0, _) = self.render_view(level, *tiles)
+        # Index rows and columns separately: this is much faster than
+        # indexing both at once.
+        view = view.take(rows - y0, axis=0).take(cols - x0, axis=1)
+        # Screen pixels in the image form a contiguous block.
+        block = pixels[inrows[0]:inrows[-1]+1, incols[0]:incols[-1]+1]
+        block[..., :view.shape[2]] = view
+        if view.shape[2] == 3:
+            block[..., 3] = 255
+        return pixels
+
+    def blit_view(self):
+        '''
+        Show the image at the current axes limits, as given by
+        'render_pixels', without drawing the figure (see blit_pixels).
+        '''
+        _, _, width, height = axes_pixels(self.axes)
+        pixels = self.render_pixels(self.axes.get_xlim(),
+                                    self.axes.get_ylim(), width, height,
+                                    axes_background(self.axes))
+        blit_pixels(self.axes, pixels)
+
+    def draw(self, renderer, *args, **kwargs):
+        if not self.get_visible() or not self.update_view():
+            return
+        super(TiledImage, self).draw(renderer, *args, **kwargs)
@@ -0,0 +1,318 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmark opening, displaying and saving images in roimanager.
+
+Synthetic ImageJ tiffs are created for every combination of image size
+(pixels along each side), number of channels and bit depth. Each image
+is then opened in a MainWindow running on Qt's offscreen platform (no
+display is needed), and the following steps are timed:
+
+  open      MainWindow.open_image (reading, pyramids, statistics and
+            the first, uncached, draw).
+  draw      Drawing the whole image again with an empty tile cache.
+  redraw    Drawing it again with the tiles cached.
+  zoom      Zooming in a few times about the centre of the image.
+  markers   Adding markers with the mouse.
+  save      MainWindow.on_buttonSaveData_released.
+  load      MainWindow.load_data.
+
+Each image is benchmarked in a separate process, so that the peak
+memory (resident set size) recorded after each step only includes that
+image. Results are written as JSON, together with the versions of the
+libraries used, so that runs of different versions can be compared.
+
+Usage:
+
+    python3 benchmark.py --sizes 2048 8192 --channels 1 3 --bits 8 16 \\
+        --output results.json
+
+Note that the largest default images need several GB of disk space
+(40960 pixels along each side, 5 channels and 16 bits is 16 GB).
+'''
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from importlib.machinery import SourceFileLoader
+from types import SimpleNamespace
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SIZES = (2048, 8192, 20480, 40960)
+CHANNELS = (1, 3, 5)
+BITS = (8, 16)
+NZOOM = 4
+NMARKERS = 100
+WINDOWSIZE = (1280, 800)
+
+
+def ij_ranges(ranges):
+    '''
+    Return the extra tags with ImageJ's display ranges (a flat list of
+    min, max for each channel), as tifffile's 'extratags'.
+    '''
+    big = sys.byteorder == 'big'
+    fmt = '>' if big else '<'
+    header = b'IJIJrang' if big else b'JIJIgnar'
+    header += struct.pack(fmt + 'I', 1)
+    body = struct.pack(fmt + 'd'*len(ranges), *ranges)
+    data = header + body
+    counts = (len(header), len(body))
+    return [(50838, 'I', len(counts), counts, True),
+            (50839, 'B', len(data), data, True)]
+
+
+def make_image(fname, size, nchannels, bits, seed=0, chunksize=1024):
+    '''
+    Write a synthetic ImageJ tiff of 'nchannels' channels of 'size' x
+    'size' pixels. Data are written through a memory map, a block of
+    rows at a time, so that images larger than memory can be created.
+    '''
+    import tifffile
+    dtype = np.dtype('uint%i' % bits)
+    vmax = np.iinfo(dtype).max
+    if nchannels == 1:
+        shape, axes = (size, size), 'YX'
+    else:
+        shape, axes = (nchannels, size, size), 'CYX'
+    im = tifffile.memmap(
+            fname, shape=shape, dtype=dtype, imagej=True,
+            metadata={'axes': axes, 'mode': 'composite', 'unit': 'micron'},
+            resolution=(1., 1.),
+            extratags=ij_ranges([0., float(vmax)] * nchannels))
+    channels = im.reshape((nchannels, size, size))
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0, 1, size)
+    for c in range(nchannels):
+        for i in range(0, size, chunksize):
+            n = min(chunksize, size - i)
+            # A gradient and noise, so that channels have a spread of
+            # intensities and do not compress to nothing.
+            y = np.linspace(i/size, (i+n)/size, n)[:, None]
+            block = (x + y) * vmax / 4 + rng.rand(n, size) * vmax / 2
+            channels[c, i:i+n] = block.astype(dtype)
+    im.flush()
+    del channels, im
+
+
+def peak_memory():
+    '''
+    Return the peak resident set size of this process, in MB.
+    '''
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS bytes.
+    if sys.platform == 'darwin':
+        return maxrss / 2**20
+    return maxrss / 2**10
+
+
+def load_roimanager():
+    '''
+    Import the roimanager script (which has no .py extension) as a
+    module.
+    '''
+    fname = os.path.join(ROOT, 'roimanager')
+    loader = SourceFileLoader('roimanager', fname)
+    spec = importlib.util.spec_from_loader('roimanager', loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def run_case(fname, nzoom=NZOOM, nmarkers=NMARKERS):
+    '''
+    Benchmark one image and return a dictionary of steps, each with
+    its wall time (s) and the peak memory so far (MB).
+    '''
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    roimanager = load_roimanager()
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication([])
+    window = roimanager.MainWindow()
+    window.resize(*WINDOWSIZE)
+    window.show()
+    app.processEvents()
+    steps = {}
+
+    def step(name, function, *args):
+        t0 = time.perf_counter()
+        result = function(*args)
+        # Include draws deferred to the event loop.
+        app.processEvents()
+        steps[name] = {'time': time.perf_counter() - t0,
+                       'memory': peak_memory()}
+        return result
+
+    if not step('open', window.open_image, fname):
+        raise RuntimeError('failed to open {}'.format(fname))
+
+    def draw(clear):
+        if clear:
+            window.tiles.clear()
+            window.composite._view = None
+        window.canvas.draw()
+
+    step('draw', draw, True)
+    step('redraw', draw, False)
+
+    window.buttonZoom.setChecked(True)
+    h, w = window.imshape[:2]
+    event = SimpleNamespace(inaxes=window.ax, xdata=w/2, ydata=h/2,
+                            button='up')
+
+    def zoom():
+        # One render per step, as with separate mouse wheel events.
+        for _ in range(nzoom):
+            window.zoom.on_zoom(event)
+            app.processEvents()
+
+    step('zoom', zoom)
+    window.buttonZoom.setChecked(False)
+    window.buttonHome.click()
+
+    window.buttonAddMarker.setChecked(True)
+    rng = np.random.RandomState(0)
+    events = [SimpleNamespace(inaxes=window.ax, xdata=x, ydata=y,
+                              button=1)
+              for x, y in rng.rand(nmarkers, 2) * (w, h)]
+
+    def add_markers():
+        for event in events:
+            window.markers.on_add(event)
+
+    step('markers', add_markers)
+    window.buttonAddMarker.setChecked(False)
+
+    step('save', window.on_buttonSaveData_released)
+    step('load', window.load_data)
+    window.markers.is_dirty = False
+    window.rois.is_dirty = False
+    window.close()
+    return steps
+
+
+def versions():
+    import matplotlib
+    import h5py
+    from PyQt5.QtCore import PYQT_VERSION_STR, QT_VERSION_STR
+    try:
+        revision = subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'roimanager': revision,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'matplotlib': matplotlib.__version__,
+            'h5py': h5py.__version__,
+            'pyqt': PYQT_VERSION_STR,
+            'qt': QT_VERSION_STR,
+            'platform': platform.platform()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='pixels along each side of the images')
+    parser.add_argument('--channels', type=int, nargs='+',
+                        default=CHANNELS, help='numbers of channels')
+    parser.add_argument('--bits', type=int, nargs='+', default=BITS,
+                        choices=(8, 16), help='bit depths')
+    parser.add_argument('--markers', type=int, default=NMARKERS,
+                        help='number of markers added')
+    parser.add_argument('--zoom', type=int, default=NZOOM,
+                        help='number of zoom steps')
+    parser.add_argument('--dir', default=None,
+                        help='directory for the images (default: a '
+                             'temporary directory, deleted afterwards)')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='JSON file with the results')
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        # Child process: benchmark one image and report to the parent
+        # in the last line of the output.
+        steps = run_case(args.case, args.zoom, args.markers)
+        print(json.dumps(steps))
+        return
+
+    path = args.dir if args.dir is not None else tempfile.mkdtemp()
+    results = {'date': datetime.datetime.now().isoformat(),
+               'versions': versions(),
+               'cases': []}
+    try:
+        for size in args.sizes:
+            for nchannels in args.channels:
+                for bits in args.bits:
+                    name = '{}px_{}ch_{}bit'.format(size, nchannels, bits)
+                    fname = os.path.join(path, name + '.tif')
+                    print(name, end=' ', flush=True)
+                    t0 = time.perf_counter()
+                    make_image(fname, size, nchannels, bits)
+                    case = {'name': name, 'size': size,
+                            'channels': nchannels, 'bits': bits,
+                            'nbytes': os.path.getsize(fname),
+                            'create': time.perf_counter() - t0}
+                    command = [sys.executable, os.path.abspath(__file__),
+                               '--case', fname,
+                               '--zoom', str(args.zoom),
+                               '--markers', str(args.markers)]
+                    proc = subprocess.run(command, stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE)
+                    if proc.returncode == 0:
+                        output = proc.stdout.decode().splitlines()
+                        case['steps'] = json.loads(output[-1])
+                        print(' '.join('{}={:.3f}s'.format(k, v['time'])
+                                       for k, v in case['steps'].items()))
+                    else:
+                        case['error'] = proc.stderr.decode().strip()
+                        print('failed')
+                    results['cases'].append(case)
+                    # Remove the image and everything derived from it.
+                    base = os.path.splitext(fname)[0]
+                    for f in os.listdir(path):
+                        if os.path.join(path, f).startswith(base):
+                            os.remove(os.path.join(path, f))
+    finally:
+        if args.dir is None:
+            shutil.rmtree(path, ignore_errors=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+# coding=utf-8
+#
+# Copyright (c) 2015-2018 Antonio González
+#
+# This file is part of roimanager.
+#
+# Roimanager is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# Roimanager is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with roimanager. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Simplify the ROIs saved in roimanager data files.
+
+The outline of each ROI (dataset 'roiset/<name>/xy') is simplified with
+rois.simplify, as roimanager does with the ROIs drawn since, and saved
+back to the file in place. Attributes (e.g. the ROI's colour) are kept.
+
+Note that HDF5 files do not shrink when datasets are replaced by
+smaller ones. To reclaim the space, copy the files with h5repack, or
+open them in roimanager and save them again.
+
+Usage:
+
+    python3 simplify_rois.py --tolerance 1 data/*.hdf5
+'''
+
+import argparse
+import os
+import sys
+
+import h5py
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rois import simplify
+
+TOLERANCE = 1
+
+
+def simplify_file(fname, tolerance=TOLERANCE, dry_run=False):
+    '''
+    Simplify the ROIs in data file 'fname'. Return the number of
+    vertices before and after.
+    '''
+    before = after = 0
+    with h5py.File(fname, 'r' if dry_run else 'r+') as f:
+        if 'roiset' not in f:
+            return before, after
+        for name in f['roiset']:
+            grp = f['roiset'][name]
+            xy = grp['xy'][...]
+            simple = simplify(xy, tolerance)
+            before += len(xy)
+            after += len(simple)
+            if dry_run or len(simple) == len(xy):
+                continue
+            attrs = dict(grp['xy'].attrs)
+            del grp['xy']
+            dset = grp.create_dataset(name='xy', data=simple)
+            for key, val in attrs.items():
+                dset.attrs[key] = val
+    return before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('files', nargs='+', help='hdf5 data files')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='maximum distance (in image pixels) between '
+                             'the original and the simplified outlines')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report how many vertices would be '
+                             'removed')
+    args = parser.parse_args()
+    for fname in args.files:
+        try:
+            before, after = simplify_file(fname, args.tolerance,
+                                          args.dry_run)
+        except (OSError, IOError) as error:
+            print('{}: {}'.format(fname, error))
+            continue
+        print('{}: {} -> {} vertices'.format(fname, before, after))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,15 +20,34 @@
 
 import numpy as np
 
+from tiles import axes_background, axes_pixels, blit_pixels
+
 
 class ZoomDragManager:
+    '''
+    Zoom in and out by clicking (or scrolling), and move the image
+    around by dragging.
+
+    While dragging, the figure is not drawn. Instead, the image is
+    rendered once (see tiles.TiledImage.render_pixels) into a buffer
+    larger than the axes, by PANMARGIN of their size on each side.
+    Each mouse motion copies the part of that buffer in view to the
+    canvas, draws the other artists (ROIs, markers) over it, and blits.
+    When the view goes beyond the buffer, the buffer is moved to be
+    centred on the view again: the part still covered is shifted, and
+    only the strips newly exposed are rendered (see 'shift_pan'). The
+    figure is drawn in full when the mouse button is released.
+    '''
+    PANMARGIN = 0.25
+
     def __init__(self, ax):
         self.canvas = ax.figure.canvas
         self.ax = ax
+        self._pan = None
 
     def connect(self):
         im = self.ax.images[0]
-        xmin, self.xmax, self.ymax, ymin = im.get_extent()
+        xmin, self.xmax, self.ymax, ymin = im.get_image_extent()
         self.cid_scroll = self.canvas.mpl_connect(
                 'scroll_event', self.on_zoom)
         self.cid_press = self.canvas.mpl_connect(
@@ -56,6 +75,7 @@ class ZoomDragManager:
         if event.button == 1:
             # Keep a reference to the point where the movement started.
             self.x0, self.y0 = event.xdata, event.ydata
+            self._pan = None
             self.cid_motion = self.canvas.mpl_connect(
                     'motion_notify_event', self.on_motion)
 
@@ -67,6 +87,10 @@ class ZoomDragManager:
         self.canvas.mpl_disconnect(self.cid_motion)
         if not self.ismotion:
             self.on_zoom(event)
+        elif self._pan is not None:
+            # Replace the panning view by the figure in full.
+            self._pan = None
+            self.canvas.draw_idle()
 
     def on_motion(self, event):
         if event.inaxes is None:
@@ -89,7 +113,81 @@ class ZoomDragManager:
         self.ismotion = True
         self.ax.set_xlim(xmin, xmax)
         self.ax.set_ylim(ymax, ymin)
-        self.canvas.draw()
+        self.blit_pan()
+
+    def blit_pan(self):
+        '''
+        Show the axes at their current limits using the panning buffer
+        (see the class docstring), rendering it first if needed.
+        '''
+        im = self.ax.images[0] if self.ax.images else None
+        if not hasattr(im, 'render_pixels'):
+            self.canvas.draw_idle()
+            return
+        _, _, w, h = axes_pixels(self.ax)
+        left, right = self.ax.get_xlim()
+        bottom, top = self.ax.get_ylim()
+        # Size of one screen pixel in data units (negative if the axis
+        # is inverted).
+        sx, sy = (right - left) / w, (bottom - top) / h
+        mcol, mrow = int(w * self.PANMARGIN), int(h * self.PANMARGIN)
+        if self._pan is not None:
+            pixels, (xref, yref), scale = self._pan
+            col = int(round((left - xref) / sx))
+            row = int(round((top - yref) / sy))
+            if pixels.shape[:2] != (h + 2*mrow, w + 2*mcol) or \
+                    not np.allclose(scale, (sx, sy)):
+                # The axes were resized or zoomed: start again.
+                self._pan = None
+            elif (not 0 <= col <= pixels.shape[1] - w or
+                    not 0 <= row <= pixels.shape[0] - h):
+                self.shift_pan(im, col - mcol, row - mrow)
+                col, row = mcol, mrow
+        if self._pan is None:
+            col, row = mcol, mrow
+            xlim = (left - col*sx, right + col*sx)
+            ylim = (bottom + row*sy, top - row*sy)
+            pixels = im.render_pixels(xlim, ylim, w + 2*col, h + 2*row,
+                                      axes_background(self.ax))
+            self._pan = pixels, (xlim[0], ylim[1]), (sx, sy)
+        pixels = self._pan[0]
+        blit_pixels(self.ax, pixels[row:row+h, col:col+w])
+
+    def shift_pan(self, im, dcol, drow):
+        '''
+        Move the panning buffer by 'dcol' columns and 'drow' rows of
+        screen pixels: copy the part of the buffer that is still
+        covered, and render only the rest (at most a band of rows and
+        one of columns).
+        '''
+        old, (xref, yref), (sx, sy) = self._pan
+        height, width = old.shape[:2]
+        xref, yref = xref + dcol*sx, yref + drow*sy
+        pixels = np.empty_like(old)
+        # Rows and columns of the new buffer also in the old one.
+        r0, r1 = max(0, -drow), min(height, height - drow)
+        c0, c1 = max(0, -dcol), min(width, width - dcol)
+        if r0 < r1 and c0 < c1:
+            pixels[r0:r1, c0:c1] = old[r0+drow:r1+drow, c0+dcol:c1+dcol]
+        else:
+            r0 = r1 = c0 = c1 = 0
+        background = axes_background(self.ax)
+
+        def render(rows, cols):
+            (i0, i1), (j0, j1) = rows, cols
+            if i0 < i1 and j0 < j1:
+                pixels[i0:i1, j0:j1] = im.render_pixels(
+                        (xref + j0*sx, xref + j1*sx),
+                        (yref + i1*sy, yref + i0*sy),
+                        j1 - j0, i1 - i0, background)
+
+        # Bands of rows above and below the part copied, and of columns
+        # to its left and right.
+        render((0, r0), (0, width))
+        render((r1, height), (0, width))
+        render((r0, r1), (0, c0))
+        render((r0, r1), (c1, width))
+        self._pan = pixels, (xref, yref), (sx, sy)
 
     def on_zoom(self, event):
         if self.canvas.widgetlock.locked():
@@ -155,4 +253,4 @@ class ZoomDragManager:
         # Set new axes limits.
         self.ax.set_xlim(xmin, xmax)
         self.ax.set_ylim(ymax, ymin)
-        self.canvas.draw()
+        self.canvas.draw_idle()